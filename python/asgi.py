@@ -0,0 +1,336 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Variante assincrona (ASGI) da API em demo-api.py:
+##   uvicorn asgi:app --host 127.0.0.1 --port 8080
+##
+## As rotas mais concorridas (inscricoes em turmas e analiticas) sao servidas por Quart sobre um
+## pool assincrono do psycopg; todas as outras /dbproj/* seguem para a aplicacao Flask original.
+##
+
+
+import asyncio
+import importlib.util
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+import psycopg
+import quart
+from a2wsgi import WSGIMiddleware
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header
+
+# demo-api.py nao e importavel pelo nome (tem hifen); carregamos o modulo pelo caminho
+_spec = importlib.util.spec_from_file_location('demo_api', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-api.py'))
+api = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(api)
+
+# Sob o uvicorn o modulo e importado e __main__ nao corre; o logging configura-se aqui, como em wsgi.py
+api.configure_logging()
+
+StatusCodes = api.StatusCodes
+logger = api.logger
+
+async_app = quart.Quart(__name__)
+
+##########################################################
+## DATABASE ACCESS
+##########################################################
+
+def record_statement(elapsed):
+    if quart.has_request_context():
+        timing = quart.g.get('timing')
+        if timing is not None:
+            timing['db'] += elapsed
+            timing['statements'] += 1
+
+
+def current_endpoint():
+    rule = quart.request.url_rule.rule if quart.request.url_rule else quart.request.path
+    return f'{quart.request.method} {rule}'
+
+
+class TimedAsyncCursor(psycopg.AsyncCursor):
+    # Como TimedCursor em demo-api.py; o EXPLAIN amostrado fica para as rotas sincronas
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            record_statement(elapsed)
+            if elapsed * 1000 >= api.SLOW_QUERY_MS:
+                api.log_slow_query(self, query, params, elapsed, explain=False, endpoint=current_endpoint())
+
+
+# Mesmos limites que o pool sincrono; aqui cada conexao serve muitos pedidos em espera de I/O
+async_pool = AsyncConnectionPool(
+    make_conninfo(**api.DB_CONFIG),
+    min_size=api.DB_POOL_MIN,
+    max_size=api.DB_POOL_MAX,
+    timeout=api.DB_POOL_TIMEOUT,
+    check=AsyncConnectionPool.check_connection,
+    kwargs={'cursor_factory': TimedAsyncCursor},
+    open=False
+)
+
+
+@async_app.before_serving
+async def open_pool():
+    await async_pool.open()
+
+
+@async_app.after_serving
+async def close_pool():
+    await async_pool.close()
+
+
+@asynccontextmanager
+async def db_connection():
+    # Conta a espera por uma conexao do pool no tempo 'acquire' do pedido, como get_db
+    start = time.perf_counter()
+    async with async_pool.connection() as conn:
+        timing = quart.g.get('timing')
+        if timing is not None:
+            timing['acquire'] += time.perf_counter() - start
+        yield conn
+
+##########################################################
+## REQUEST METRICS
+##########################################################
+
+# As rotas Quart entram nas mesmas metricas (/metrics) que as rotas Flask
+@async_app.before_request
+async def start_timing():
+    quart.g.timing = {'start': time.perf_counter(), 'db': 0.0, 'statements': 0, 'acquire': 0.0}
+
+
+@async_app.after_request
+async def record_timing(response):
+    timing = quart.g.get('timing')
+    if timing is not None:
+        endpoint = quart.request.url_rule.rule if quart.request.url_rule else 'unmatched'
+        api.finish_timing(timing, endpoint, quart.request.method, response)
+    return response
+
+##########################################################
+## AUTHENTICATION HELPERS
+##########################################################
+
+def token_required(f):
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        token = quart.request.headers.get('Authorization')
+
+        if not token:
+            return quart.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Token is missing!', 'results': None})
+
+        claims, error_message = api.read_token(token, 'access')
+        if error_message:
+            return quart.jsonify({'status': StatusCodes['unauthorized'], 'errors': error_message, 'results': None}), 401
+
+        quart.g.user_id = claims['id']
+        quart.g.roles = frozenset(claims.get('roles', ()))
+
+        return await f(*args, **kwargs)
+    return decorated
+
+
+def requires_role(role):
+    def decorator(f):
+        @wraps(f)
+        async def decorated(*args, **kwargs):
+            if role not in quart.g.roles:
+                return quart.jsonify({'status': StatusCodes['unauthorized'], 'errors': api.RoleErrors[role], 'results': None}), 401
+            return await f(*args, **kwargs)
+        return decorated
+    return decorator
+
+##########################################################
+## RESULT CACHE
+##########################################################
+
+def cached_result(namespace):
+    # Mesmas chaves, entradas e regras de 304 que cached_result em demo-api.py, logo as invalidacoes feitas
+    # pelas rotas sincronas (submit_grades, delete_details, ...) tambem valem aqui. As chamadas a cache
+    # (Redis) correm numa thread para nao bloquearem o event loop
+    def decorator(f):
+        @wraps(f)
+        async def decorated(*args, **kwargs):
+            try:
+                key, entry = await asyncio.to_thread(api.get_cached_result, namespace, kwargs, quart.request.args)
+            except Exception as error:
+                logger.error(f'Result cache unavailable: {error}')
+                return await f(*args, **kwargs)
+
+            if entry is None:
+                response = await f(*args, **kwargs)
+                if not isinstance(response, quart.Response) or response.status_code != 200:
+                    return response
+
+                entry = api.make_cache_entry(await response.get_data(as_text=True))
+                if entry is None:
+                    return response
+                await asyncio.to_thread(api.store_cached_result, key, entry)
+
+            return api.cached_response(quart.Response, entry, quart.request)
+        return decorated
+    return decorator
+
+##########################################################
+## ENDPOINTS
+##########################################################
+
+@async_app.route('/dbproj/enroll_course_edition/<course_edition_id>', methods=['POST'])
+@token_required
+@requires_role('student')
+async def enroll_course_edition(course_edition_id):
+    student_id = quart.g.user_id
+
+    data = await quart.request.get_json()
+    classes = data.get('classes', [])
+
+    class_ids, error_message = api.parse_class_ids(classes, course_edition_id)
+    if error_message:
+        return quart.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
+
+    async with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            # O mesmo protocolo que a rota sincrona: bloquear as turmas, validar e inscrever na mesma transacao
+            await api.statements.execute_async(cur, api.LOCK_EDITION_STATEMENT, (int(course_edition_id),))
+            await api.statements.execute_async(cur, api.LOCK_CLASSES_STATEMENT, (class_ids,))
+            class_info = {row[0]: row[1:] for row in await cur.fetchall()}
+
+            error_message = api.check_classes(class_ids, class_info, course_edition_id)
+            if error_message:
+                await conn.rollback()
+                return quart.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
+
+            await cur.execute(api.ENROLL_CLASSES_QUERY, {'student_id': student_id, 'class_ids': class_ids, 'edition_id': int(course_edition_id)})
+
+            await conn.commit()
+            response = {'status': StatusCodes['success'], 'errors': None, 'results': f'Successfully enrolled in classes: {classes}'}
+
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'POST /enroll_course_edition - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+            await conn.rollback()
+
+    return quart.jsonify(response)
+
+@async_app.route('/dbproj/top3', methods=['GET'])
+@token_required
+@requires_role('admin')
+@cached_result('top3')
+async def top3_students():
+    async with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute(api.TOP3_QUERY)
+            result_top3 = [api.top3_record(row) for row in await cur.fetchall()]
+            response = {'status': StatusCodes['success'], 'errors': None, 'results': result_top3}
+
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'GET /dbproj/top3 - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
+            await conn.rollback()
+
+    return quart.jsonify(response)
+
+@async_app.route('/dbproj/top_by_district', methods=['GET'])
+@token_required
+@requires_role('admin')
+@cached_result('top_by_district')
+async def top_by_district():
+    async with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute(api.TOP_BY_DISTRICT_QUERY)
+            result_top_by_district = [api.top_by_district_record(row) for row in await cur.fetchall()]
+            response = {'status': StatusCodes['success'], 'errors': None, 'results': result_top_by_district}
+
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'GET /top_by_district - error: {error}')
+            response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
+            await conn.rollback()
+
+    return quart.jsonify(response)
+
+@async_app.route('/dbproj/report', methods=['GET'])
+@token_required
+@requires_role('admin')
+@cached_result('report')
+async def monthly_report():
+    year = quart.request.args.get('year')
+    if year is not None:
+        if not year.isdigit():
+            return quart.jsonify({'status': StatusCodes['api_error'], 'errors': 'year must be a positive integer', 'results': None})
+        year = int(year)
+
+    query = api.MONTHLY_REPORT_QUERY.format(year_filter='AND m.year_ = %(year)s' if year is not None else '')
+
+    async with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute(query, {'year': year})
+            resultReport = [api.monthly_report_record(row) for row in await cur.fetchall()]
+            response = {'status': StatusCodes['success'], 'errors': None, 'results': resultReport}
+        except Exception as e:
+            response = {'status': StatusCodes['internal_error'], 'errors': str(e), 'results': None}
+            await conn.rollback()
+
+    return quart.jsonify(response)
+
+##########################################################
+## ASGI ENTRY POINT
+##########################################################
+
+# As rotas Flask correm num pool de threads do tamanho do pool sincrono (uma conexao por thread), como
+# os workers gthread; o WsgiToAsgi do asgiref punha-as todas na mesma thread
+wsgi_app = WSGIMiddleware(api.create_app(), workers=api.DB_POOL_MAX)
+_async_routes = async_app.url_map.bind('')
+
+
+def serves_async(scope):
+    # Exportacoes em streaming (NDJSON/CSV) continuam na rota sincrona, que usa cursores do lado do servidor
+    headers = dict(scope['headers'])
+    accept = parse_accept_header(headers.get(b'accept', b'').decode('latin-1'), MIMEAccept)
+    if accept.best_match(('application/json',) + api.EXPORT_FORMATS) in api.EXPORT_FORMATS:
+        return False
+    try:
+        _async_routes.match(scope['path'], method=scope['method'])
+        return True
+    except HTTPException:
+        return False
+
+
+async def app(scope, receive, send):
+    # lifespan vai sempre para o Quart, que abre e fecha o pool assincrono
+    if scope['type'] == 'lifespan' or (scope['type'] == 'http' and serves_async(scope)):
+        await async_app(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    host = '127.0.0.1'
+    port = 8080
+    logger.info(f'API stubs online (ASGI): http://{host}:{port}')
+    uvicorn.run(app, host=host, port=port)
@@ -0,0 +1,151 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Benchmark de top3 e top_by_district com a tabela grade a crescer (a partir da pasta python):
+##   python bench_averages.py [--students 10000] [--grades 100000,1000000,10000000] [--repeat 5]
+##
+## Cria --students alunos e vai acrescentando notas (nos periodos que ja existem) ate cada tamanho de
+## --grades, mantendo student_average como submit_grades. Em cada tamanho mede TOP3_QUERY e
+## TOP_BY_DISTRICT_QUERY, que so leem student_average, e as queries antigas sobre grade ate
+## --old-max-grades (a antiga top_by_district e quadratica por distrito). Com o numero de alunos fixo,
+## o que top3 ainda cresce vem das notas dos tres alunos que devolve, nao do tamanho de grade.
+## Tudo e desfeito com rollback no fim (ver bench_db.py).
+##
+
+
+import argparse
+
+from bench_db import api, connect, seed_students, refresh_statistics, best_of
+
+# Versoes anteriores a student_average, para comparacao
+OLD_TOP3_QUERY = '''
+    SELECT p.name AS student_name,
+        AVG(g.grade) AS average,
+        (
+        SELECT (g_info.grade, g_info.date_of_grade, e.name, e.id)
+            FROM grade g_info
+            JOIN period_ p2 ON g_info.period__id = p2.id
+            JOIN edition e ON p2.edition_id = e.id
+            JOIN course_edition ce ON e.id = ce.edition_id
+            JOIN course c ON c.id_course = ce.course_id_course
+            WHERE g_info.student_person_id = s.person_id
+            LIMIT 1
+        ) AS grades_info,
+        (
+            SELECT (STRING_AGG(ea.name::text, ','))
+            FROM student_extracurriclar_activities sea
+            JOIN extracurriclar_activities ea ON ea.id_activities = sea.extracurriclar_activities_id_activities
+            WHERE sea.student_person_id = s.person_id
+        ) AS extracurricular_activities
+    FROM student s
+    JOIN person p ON p.id = s.person_id
+    JOIN grade g ON s.person_id = g.student_person_id
+    GROUP BY s.person_id, p.username
+    ORDER BY AVG(g.grade) DESC LIMIT 3
+'''
+
+OLD_TOP_BY_DISTRICT_QUERY = '''
+    SELECT
+        p.id AS student_id,
+        p.district,
+        AVG(g.grade) AS average
+    FROM person p
+    JOIN student s ON p.id = s.person_id
+    JOIN grade g ON s.person_id = g.student_person_id
+    GROUP BY p.id, p.district
+    HAVING
+        AVG(g.grade) = (
+            SELECT MAX(avg_grade)
+            FROM (
+                SELECT p2.district, AVG(g2.grade) AS avg_grade
+                FROM person p2
+                JOIN student s2 ON p2.id = s2.person_id
+                JOIN grade g2 ON s2.person_id = g2.student_person_id
+                WHERE p2.district = p.district
+                GROUP BY s2.person_id, p2.district
+            ) AS district_averages
+        )
+    ORDER BY average DESC
+'''
+
+
+def seed_grades(cur, students, periods, start, stop):
+    # Notas de 0 a 20 repartidas pelos alunos e periodos; as medias seguem pelo mesmo UPSERT que submit_grades
+    cur.execute('''
+        WITH new_grades AS (
+            INSERT INTO grade (student_person_id, period__id, date_of_grade, grade, aproved)
+            SELECT students[1 + mod(i, cardinality(students))],
+                   periods[1 + mod(i / cardinality(students), cardinality(periods))],
+                   DATE '2024-01-01' + mod(i, 365)::int,
+                   mod(i * 7, 21),
+                   mod(i * 7, 21) >= %(approval)s
+            FROM generate_series(%(start)s::bigint, %(stop)s::bigint - 1) i,
+                 (SELECT %(students)s::bigint[] AS students, %(periods)s::bigint[] AS periods) ids
+            RETURNING student_person_id, grade
+        )
+        INSERT INTO student_average (student_person_id, district, grade_sum, grade_count)
+        SELECT p.id, p.district, SUM(new_grades.grade), COUNT(*)
+        FROM new_grades
+        JOIN person p ON p.id = new_grades.student_person_id
+        GROUP BY p.id, p.district
+        ON CONFLICT (student_person_id) DO UPDATE
+        SET grade_sum = student_average.grade_sum + EXCLUDED.grade_sum,
+            grade_count = student_average.grade_count + EXCLUDED.grade_count
+    ''', {'students': students, 'periods': periods, 'start': start, 'stop': stop, 'approval': api.APPROVAL_GRADE})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of top3 and top_by_district as the grade table grows')
+    parser.add_argument('--students', type=int, default=10000)
+    parser.add_argument('--grades', default='100000,1000000,10000000', help='comma-separated grade table sizes')
+    parser.add_argument('--old-max-grades', type=int, default=100000, help='largest size at which the old queries are timed')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.grades.split(','))
+
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM period_ ORDER BY id')
+        periods = [row[0] for row in cur.fetchall()]
+        if not periods:
+            raise SystemExit('No rows in period_: create at least one edition period before running the benchmark')
+
+        students = seed_students(cur, args.students)
+        cur.execute('SELECT COUNT(*) FROM grade')
+        existing = cur.fetchone()[0]
+
+        print(f'{args.students} synthetic students, {len(periods)} periods, {existing} existing grades, best of {args.repeat}')
+        print(f'{"grades":>12} {"top3":>10} {"by_district":>12} {"old top3":>10} {"old by_district":>16}')
+        seeded = 0
+        for size in sizes:
+            if size > existing + seeded:
+                seed_grades(cur, students, periods, seeded, size - existing)
+                seeded = size - existing
+            refresh_statistics(cur, 'grade', 'student_average', 'person', 'student')
+
+            top3, _ = best_of(cur, api.TOP3_QUERY, None, args.repeat)
+            by_district, _ = best_of(cur, api.TOP_BY_DISTRICT_QUERY, None, args.repeat)
+            if existing + seeded <= args.old_max_grades:
+                old_top3 = f'{best_of(cur, OLD_TOP3_QUERY, None, args.repeat)[0] * 1000:.1f}'
+                old_by_district = f'{best_of(cur, OLD_TOP_BY_DISTRICT_QUERY, None, args.repeat)[0] * 1000:.1f}'
+            else:
+                old_top3 = old_by_district = '-'
+            print(f'{existing + seeded:>12} {top3 * 1000:>10.1f} {by_district * 1000:>12.1f} {old_top3:>10} {old_by_district:>16}')
+        print('times in ms')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
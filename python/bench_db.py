@@ -0,0 +1,75 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Funcoes comuns aos benchmarks que correm contra a base de dados (bench_averages.py, ...).
+##
+## Precisam das tabelas do projeto e de sql/performance.sql, e usam a mesma configuracao (DB_* no .env)
+## que a API. Os dados sinteticos sao criados numa unica transacao que e desfeita no fim: a base de
+## dados fica como estava. Tabelas de catalogo (edicoes, periodos, turmas, cursos) nao sao criadas,
+## usam-se as que ja existirem.
+##
+
+
+import importlib.util
+import os
+import time
+
+import psycopg
+
+# demo-api.py nao e importavel pelo nome (tem hifen); carregamos o modulo pelo caminho
+_spec = importlib.util.spec_from_file_location('demo_api', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-api.py'))
+api = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(api)
+
+_seeded = 0
+
+
+def connect():
+    # Sem autocommit: tudo o que o benchmark cria fica na transacao que o rollback desfaz
+    return psycopg.connect(**api.DB_CONFIG)
+
+
+def seed_students(cur, count, districts=20):
+    # Pessoas e alunos sinteticos com nomes e numeros que nao colidem entre chamadas
+    global _seeded
+    cur.execute('''
+        WITH p AS (
+            INSERT INTO person (username, address, district, email, password, birth_date, name)
+            SELECT %(prefix)s || i, 'Bench street ' || i, 'District ' || mod(i, %(districts)s),
+                   %(prefix)s || i || '@bench.invalid', 'x', DATE '2000-01-01', 'Bench student ' || i
+            FROM generate_series(%(start)s + 1, %(start)s + %(count)s) i
+            RETURNING id
+        )
+        INSERT INTO student (n_student, ammount, mensal_debt, person_id)
+        SELECT 1000000000 + %(start)s + row_number() OVER (ORDER BY id), 0, 0, id FROM p
+        RETURNING person_id
+    ''', {'prefix': f'bench{os.getpid()}_', 'districts': districts, 'start': _seeded, 'count': count})
+    _seeded += count
+    return sorted(row[0] for row in cur.fetchall())
+
+
+def refresh_statistics(cur, *tables):
+    # ANALYZE pode correr dentro da transacao; sem ele o planner ve as tabelas com o tamanho antigo
+    for table in tables:
+        cur.execute(f'ANALYZE {table}')
+
+
+def best_of(cur, query, params, repeat):
+    # Melhor de varias execucoes, para o ruido pesar menos; devolve (segundos, linhas)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        rows = len(cur.fetchall())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
@@ -0,0 +1,88 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Benchmark da serializacao das respostas (a partir da pasta python):
+##   python bench_json.py [--rows 10000] [--repeat 5]
+##
+## Compara dumps_json e o OrjsonProvider com o StdlibJSONProvider (o que a aplicacao usa sem orjson)
+## em linhas sinteticas com Decimal e datas, como as que saem das queries. Nao precisa de base de dados.
+##
+
+
+import argparse
+import datetime
+import importlib.util
+import os
+import random
+import timeit
+from decimal import Decimal
+
+import flask
+
+# demo-api.py nao e importavel pelo nome (tem hifen); carregamos o modulo pelo caminho
+_spec = importlib.util.spec_from_file_location('demo_api', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-api.py'))
+api = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(api)
+
+
+def make_rows(n):
+    rng = random.Random(42)
+    start = datetime.date(2024, 9, 1)
+    return [{
+        'id': i,
+        'student_name': f'student {i}',
+        'district': rng.choice(('Coimbra', 'Lisboa', 'Porto', 'Aveiro', 'Leiria')),
+        'average_grade': Decimal(rng.randint(0, 2000)) / 100,
+        'ammount': Decimal(rng.randint(0, 100000)) / 100,
+        'birth_date': start - datetime.timedelta(days=rng.randint(6000, 12000)),
+        'evaluation_date': start + datetime.timedelta(days=rng.randint(0, 300)),
+        'created_at': datetime.datetime(2024, 9, 1, 8, 0) + datetime.timedelta(seconds=rng.randint(0, 10 ** 7)),
+        'grades': [{'course': f'course {c}', 'grade': Decimal(rng.randint(0, 200)) / 10} for c in range(3)]
+    } for i in range(n)]
+
+
+def bench(label, fn, repeat):
+    # O melhor de varias repeticoes, para o ruido da maquina pesar menos
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    print(f'{label:<32} {best * 1000:9.1f} ms')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the JSON serialization used by the API responses')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    payload = {'status': api.StatusCodes['success'], 'errors': None, 'results': rows}
+
+    app = flask.Flask(__name__)
+    stdlib_provider = api.StdlibJSONProvider(app)
+
+    print(f'{args.rows} rows, best of {args.repeat}')
+    baseline = bench('StdlibJSONProvider.dumps', lambda: stdlib_provider.dumps(payload), args.repeat)
+    bench('StdlibJSONProvider.response', lambda: stdlib_provider.response(payload), args.repeat)
+    bench('dumps_json', lambda: api.dumps_json(payload), args.repeat)
+
+    if api.orjson is None:
+        print('orjson is not installed: dumps_json uses the stdlib json and OrjsonProvider is not available')
+        return
+
+    orjson_provider = api.OrjsonProvider(app)
+    best = bench('OrjsonProvider.dumps', lambda: orjson_provider.dumps(payload), args.repeat)
+    bench('OrjsonProvider.response', lambda: orjson_provider.response(payload), args.repeat)
+    print(f'OrjsonProvider.dumps is {baseline / best:.1f}x faster than StdlibJSONProvider.dumps')
+
+
+if __name__ == '__main__':
+    main()
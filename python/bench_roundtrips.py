@@ -0,0 +1,166 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Benchmark das idas e voltas a base de dados nos endpoints com varias instrucoes (a partir da pasta python):
+##   python bench_roundtrips.py [--repeat 50]
+##
+## Compara, para enroll_degree, register/staff e register/instructor, o codigo atual (pipeline ou um
+## unico statement com CTE) com a execucao sequencial do codigo antigo, uma instrucao de cada vez.
+## Com o psycopg2 instalado, a versao sequencial corre tambem sobre ele, como no codigo original.
+## Cada instrucao fora de um pipeline espera pela sua resposta (uma ida e volta); um pipeline ou um
+## statement so custam uma. A diferenca cresce com a latencia da rede: medir tambem com DB_HOST remoto.
+## Cada execucao e desfeita com rollback (ver bench_db.py).
+##
+
+
+import argparse
+import datetime
+import os
+import statistics
+import time
+
+from bench_db import api, connect, seed_students
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+ENROLL_DATE = datetime.date(2025, 9, 1)
+PREFIX = f'bench{os.getpid()}_staff'
+
+
+def staff_values(i):
+    return (f'{PREFIX}{i}', 'Bench street', 'District 1', f'{PREFIX}{i}@bench.invalid', 'x', datetime.date(1990, 1, 1), f'Bench staff {i}'), str(2000000000 + i)
+
+
+# Codigo antigo: uma instrucao (e uma ida e volta) de cada vez; so usa %s, por isso corre em psycopg e psycopg2
+
+def enroll_sequential(conn, n_student, degree_id):
+    cur = conn.cursor()
+    cur.execute('SELECT person_id FROM student WHERE n_student = %s', (n_student,))
+    person_id = cur.fetchone()[0]
+    cur.execute('SELECT id FROM degree WHERE id = %s', (degree_id,))
+    cur.fetchone()
+    cur.execute('INSERT INTO enrollement (enroll_date, student_person_id, degree_id) VALUES (%s, %s, %s)', (ENROLL_DATE, person_id, degree_id))
+
+
+def staff_sequential(conn, values, n_staff):
+    cur = conn.cursor()
+    cur.execute(api.PERSON_STATEMENT, values)
+    person_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO staff (n_staff, person_id) VALUES (%s, %s)', (n_staff, person_id))
+    cur.execute('INSERT INTO admin (staff_person_id) VALUES (%s)', (person_id,))
+
+
+def instructor_sequential(conn, values, n_staff):
+    cur = conn.cursor()
+    cur.execute(api.PERSON_STATEMENT, values)
+    person_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO staff (n_staff, person_id) VALUES (%s, %s)', (n_staff, person_id))
+    cur.execute('INSERT INTO professor (cordenad, asistente, staff_person_id) VALUES (%s, %s, %s)', (False, True, person_id))
+
+# Codigo atual (demo-api.py)
+
+def enroll_pipelined(conn, n_student, degree_id):
+    student_cur = conn.cursor()
+    degree_cur = conn.cursor()
+    cur = conn.cursor()
+    with conn.pipeline():
+        api.statements.execute(student_cur, api.STUDENT_BY_NUMBER_STATEMENT, (n_student,))
+        api.statements.execute(degree_cur, api.DEGREE_EXISTS_STATEMENT, (degree_id,))
+        api.statements.execute(cur, api.ENROLL_DEGREE_STATEMENT, (ENROLL_DATE, n_student, degree_id))
+    student_cur.fetchone()
+    degree_cur.fetchone()
+
+
+def staff_cte(conn, values, n_staff):
+    cur = conn.cursor()
+    cur.execute(api.STAFF_ADMIN_STATEMENT, values + (n_staff,))
+    cur.fetchone()
+
+
+def instructor_cte(conn, values, n_staff):
+    cur = conn.cursor()
+    cur.execute(api.INSTRUCTOR_STATEMENT, values + (n_staff, False, True))
+    cur.fetchone()
+
+
+def enroll_setup(degree_id):
+    # Um aluno novo por execucao, criado fora do tempo medido
+    def setup(conn, i):
+        cur = conn.cursor()
+        person_id = seed_students(cur, 1)[0]
+        cur.execute('SELECT n_student FROM student WHERE person_id = %s', (person_id,))
+        return str(cur.fetchone()[0]), degree_id
+    return setup
+
+
+def staff_setup(conn, i):
+    return staff_values(i)
+
+
+def run(conn, setup, fn, repeat):
+    # Mediana de varias execucoes; cada uma e desfeita com rollback
+    times = []
+    for i in range(repeat):
+        args = setup(conn, i)
+        start = time.perf_counter()
+        fn(conn, *args)
+        times.append(time.perf_counter() - start)
+        conn.rollback()
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Round-trip benchmark of the multi-statement endpoints')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    conn = connect()
+    legacy_conn = psycopg2.connect(**api.DB_CONFIG) if psycopg2 is not None else None
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM degree ORDER BY id LIMIT 1')
+        degree = cur.fetchone()
+        conn.rollback()
+
+        cases = []
+        if degree is not None:
+            setup = enroll_setup(degree[0])
+            cases.append(('enroll_degree', setup, (('sequential', 3, enroll_sequential), ('pipeline', 1, enroll_pipelined))))
+        else:
+            print('No rows in degree: skipping enroll_degree')
+        cases.append(('register/staff', staff_setup, (('sequential', 3, staff_sequential), ('single CTE', 1, staff_cte))))
+        cases.append(('register/instructor', staff_setup, (('sequential', 3, instructor_sequential), ('single CTE', 1, instructor_cte))))
+
+        print(f'median of {args.repeat} runs against {api.DB_CONFIG["host"]}:{api.DB_CONFIG["port"]}')
+        print(f'{"endpoint":<20} {"variant":<22} {"round trips":>11} {"ms":>8}')
+        for endpoint, setup, variants in cases:
+            for variant, round_trips, fn in variants:
+                elapsed = run(conn, setup, fn, args.repeat)
+                print(f'{endpoint:<20} {"psycopg " + variant:<22} {round_trips:>11} {elapsed * 1000:>8.2f}')
+                if legacy_conn is not None and variant == 'sequential':
+                    elapsed = run(legacy_conn, setup, fn, args.repeat)
+                    print(f'{endpoint:<20} {"psycopg2 " + variant:<22} {round_trips:>11} {elapsed * 1000:>8.2f}')
+        if legacy_conn is None:
+            print('psycopg2 is not installed: the old driver was not measured')
+    finally:
+        conn.rollback()
+        conn.close()
+        if legacy_conn is not None:
+            legacy_conn.rollback()
+            legacy_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Benchmark de student_details com historicos longos (a partir da pasta python):
+##   python bench_student_details.py [--editions 10,25,50,100] [--grades-per-edition 3] [--repeat 5]
+##
+## Para cada tamanho de --editions cria um aluno inscrito numa turma de cada uma dessas edicoes, com
+## --grades-per-edition notas em cada, e compara STUDENT_DETAILS_QUERY (notas ligadas a edicao pelo
+## period_) com a query antiga, que cruzava todas as edicoes com todas as notas do aluno. Usa as
+## edicoes que ja existem com turma, periodo e curso; se houver menos do que o pedido, mede ate onde der.
+## Tudo e desfeito com rollback no fim (ver bench_db.py).
+##
+
+
+import argparse
+
+from bench_db import api, connect, seed_students, refresh_statistics, best_of
+
+# Versao anterior, para comparacao: produto edicoes x notas e um EXISTS por edicao
+OLD_STUDENT_DETAILS_QUERY = '''
+    SELECT
+        e.id AS edition_id,
+        c.name AS course_name,
+        e.year_ AS edition_year,
+        g.grade
+    FROM edition e
+    JOIN course_edition ce ON ce.edition_id = e.id
+    JOIN course c ON ce.course_id_course = c.id_course
+    JOIN grade g ON g.student_person_id = %(student_id)s
+    JOIN period_ p ON p.id = g.period__id
+    WHERE EXISTS (
+        SELECT 1 FROM enrolment_class ec
+        WHERE ec.student_person_id = %(student_id)s
+        AND ec.class_time_table_id IN (
+            SELECT ct.id FROM class_time_table ct WHERE ct.edition_id = e.id
+        )
+    )
+    ORDER BY e.year_ DESC, e.id DESC
+'''
+
+
+def seed_history(cur, student_id, editions, grades_per_edition):
+    # Uma turma e grades_per_edition notas em cada edicao
+    class_ids = [class_id for _, class_id, _ in editions]
+    period_ids = [period_id for _, _, period_id in editions]
+    cur.execute('''
+        INSERT INTO enrolment_class (entry, student_person_id, class_time_table_id)
+        SELECT TRUE, %(student_id)s, unnest(%(class_ids)s::bigint[])
+    ''', {'student_id': student_id, 'class_ids': class_ids})
+    cur.execute('''
+        INSERT INTO grade (student_person_id, period__id, date_of_grade, grade, aproved)
+        SELECT %(student_id)s, period_id, DATE '2024-01-01' + n, mod(n * 7, 21), mod(n * 7, 21) >= %(approval)s
+        FROM unnest(%(period_ids)s::bigint[]) AS period_id, generate_series(1, %(grades)s) n
+    ''', {'student_id': student_id, 'period_ids': period_ids, 'grades': grades_per_edition, 'approval': api.APPROVAL_GRADE})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of student_details for students with long histories')
+    parser.add_argument('--editions', default='10,25,50,100', help='comma-separated numbers of editions per student')
+    parser.add_argument('--grades-per-edition', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.editions.split(','))
+
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        # Edicoes com turma, periodo e curso: as unicas que aparecem no resultado das duas queries
+        cur.execute('''
+            SELECT e.id, MIN(ct.id), MIN(pe.id)
+            FROM edition e
+            JOIN class_time_table ct ON ct.edition_id = e.id
+            JOIN period_ pe ON pe.edition_id = e.id
+            WHERE EXISTS (SELECT 1 FROM course_edition ce WHERE ce.edition_id = e.id)
+            GROUP BY e.id
+            ORDER BY e.id
+        ''')
+        editions = cur.fetchall()
+        if not editions:
+            raise SystemExit('No edition has a class, a period and a course: nothing to benchmark')
+        if len(editions) < sizes[-1]:
+            print(f'Only {len(editions)} editions with a class, a period and a course are available')
+            sizes = sorted({min(size, len(editions)) for size in sizes})
+
+        query = api.STUDENT_DETAILS_QUERY.format(edition_filter=api.STUDENT_EDITIONS_FILTER)
+        print(f'{args.grades_per_edition} grades per edition, best of {args.repeat}')
+        print(f'{"editions":>9} {"ms":>10} {"rows":>8} {"old ms":>10} {"old rows":>10}')
+        for size in sizes:
+            student_id = seed_students(cur, 1)[0]
+            seed_history(cur, student_id, editions[:size], args.grades_per_edition)
+            refresh_statistics(cur, 'grade', 'enrolment_class')
+
+            params = {'student_id': student_id}
+            elapsed, rows = best_of(cur, query, params, args.repeat)
+            old_elapsed, old_rows = best_of(cur, OLD_STUDENT_DETAILS_QUERY, params, args.repeat)
+            print(f'{size:>9} {elapsed * 1000:>10.1f} {rows:>8} {old_elapsed * 1000:>10.1f} {old_rows:>10}')
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
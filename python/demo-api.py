@@ -18,60 +18,1303 @@
 
 import flask
 import logging
-import psycopg2
+import logging.handlers
+import psycopg
+import psycopg.adapt
+import flask.json.provider
 import datetime
 import jwt
-from functools import wraps
-import bcrypt
+from functools import wraps, partial
+from hashing import bcrypt_hash, bcrypt_check
 from dotenv import load_dotenv
 import os
+import threading
+import time
+import random
+import re
+import queue
+import atexit
+from contextlib import contextmanager
+from psycopg import pq
+from weakref import WeakKeyDictionary
+import json
+import hashlib
+import csv
+import io
+from decimal import Decimal
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
 
 load_dotenv()
 
 SECRET_KEY = os.getenv('SECRET_KEY', 'default_secret_key') 
 
-app = flask.Flask(__name__)
-app.config['JWT_SECRET_KEY'] = 'some_jwt_secret_key'
+# As rotas e os comandos ficam no blueprint; a aplicacao e criada por create_app (ver wsgi.py)
+bp = flask.Blueprint('dbproj', __name__, cli_group=None)
+
+# Os handlers sao configurados por quem arranca a aplicacao (ver __main__, wsgi.py e asgi.py)
+logger = logging.getLogger('logger')
 
 StatusCodes = {
     'success': 200,
     'api_error': 400,
     'internal_error': 500,
-    'unauthorized': 401
+    'unauthorized': 401,
+    'service_unavailable': 503
 }
 
+##########################################################
+## LOGGING
+##########################################################
+
+# Os pedidos so poem os registos numa fila; um QueueListener escreve-os no ficheiro (JSON, rotativo)
+# e na consola numa thread propria
+LOG_FILE = os.getenv('LOG_FILE', 'log_file.log')
+# Com varios processos (workers do gunicorn) cada um escreve no seu ficheiro, p.ex. log_file.<pid>.log,
+# porque um RotatingFileHandler por processo no mesmo ficheiro perde e mistura registos ao rodar
+LOG_PER_PROCESS = os.getenv('LOG_PER_PROCESS', '0') == '1'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN')  # p.ex. 'midnight'; sem valor roda por tamanho
+LOG_REDACT = os.getenv('LOG_REDACT', '1') == '1'
+# Nos endpoints mais chamados so uma fracao dos pedidos deixa registos INFO/DEBUG (avisos e erros ficam sempre)
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+LOG_SAMPLED_ENDPOINTS = frozenset(filter(None, os.getenv(
+    'LOG_SAMPLED_ENDPOINTS', '/dbproj/top3,/dbproj/top_by_district,/dbproj/enroll_course_edition/<course_edition_id>').split(',')))
+
+SENSITIVE_FIELDS = frozenset(('password', 'token', 'access_token', 'refresh_token', 'authorization'))
+REDACTED = '[REDACTED]'
+REDACT_PATTERNS = (
+    (re.compile(r'(Bearer\s+)\S+', re.IGNORECASE), r'\1' + REDACTED),
+    (re.compile(r'eyJ[\w-]+\.[\w-]+\.[\w-]+'), REDACTED),
+    (re.compile(r'\$2[aby]?\$\d{2}\$[./A-Za-z0-9]{53}'), REDACTED),
+    (re.compile(r'''(['"]?(?:password|token|access_token|refresh_token)['"]?\s*[:=]\s*)('[^']*'|"[^"]*"|[^\s,}]+)''', re.IGNORECASE), r'\1' + REDACTED),
+)
+
+
+def redact(text):
+    for pattern, replacement in REDACT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def log_payload(route, data):
+    # O payload so e formatado se DEBUG estiver ativo; os campos sensiveis nunca saem do pedido
+    if logger.isEnabledFor(logging.DEBUG):
+        if isinstance(data, dict):
+            data = {key: REDACTED if key.lower() in SENSITIVE_FIELDS else value for key, value in data.items()}
+        logger.debug('%s - payload: %s', route, data)
+
+
+class RequestContextFilter(logging.Filter):
+    # Corre na thread do pedido: junta o endpoint, aplica a amostragem e a redacao antes de ir para a fila
+    def filter(self, record):
+        record.endpoint = None
+        if flask.has_request_context():
+            rule = flask.request.url_rule.rule if flask.request.url_rule else flask.request.path
+            record.endpoint = f'{flask.request.method} {rule}'
+
+            if record.levelno < logging.WARNING and rule in LOG_SAMPLED_ENDPOINTS:
+                if 'log_sampled' not in flask.g:
+                    flask.g.log_sampled = random.random() < LOG_SAMPLE_RATE
+                if not flask.g.log_sampled:
+                    return False
+
+        if LOG_REDACT:
+            record.msg = redact(record.getMessage())
+            record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'endpoint', None):
+            entry['endpoint'] = record.endpoint
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_log_listener = None
+
+
+def process_log_file(path):
+    if not LOG_PER_PROCESS:
+        return path
+    base, ext = os.path.splitext(path)
+    return f'{base}.{os.getpid()}{ext}'
+
+
+def configure_logging(console=True):
+    # Chamado uma vez por processo por quem arranca a aplicacao (__main__, wsgi.py, asgi.py)
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(process_log_file(LOG_FILE), when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(process_log_file(LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S'))
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    # Escrever o que ainda estiver na fila antes de o processo sair
+    atexit.register(_log_listener.stop)
+
+##########################################################
+## JSON
+##########################################################
+
+# Respostas serializadas com orjson quando esta instalado; sem ele, o json da biblioteca padrao
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Com orjson >= 3.10 o json_agg de top3 passa para a resposta sem ser descodificado (so nesse cursor)
+JSON_PASSTHROUGH = os.getenv('JSON_PASSTHROUGH', '1') == '1' and orjson is not None and hasattr(orjson, 'Fragment')
+ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default, option=ORJSON_OPTIONS).decode()
+    return json.dumps(value, default=json_default, sort_keys=True)
+
+
+class OrjsonProvider(flask.json.provider.JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Os bytes do orjson vao diretamente para a resposta, sem passar por str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS), mimetype='application/json')
+
+
+class StdlibJSONProvider(flask.json.provider.DefaultJSONProvider):
+    default = staticmethod(json_default)
+
+
+class JsonFragmentLoader(psycopg.adapt.Loader):
+    def load(self, data):
+        return orjson.Fragment(bytes(data))
+
+
 ##########################################################
 ## DATABASE ACCESS
 ##########################################################
 
+DB_CONFIG = {
+    'user': os.getenv('DB_USER', 'aulaspl'),
+    'password': os.getenv('DB_PASSWORD', 'aulaspl'),
+    'host': os.getenv('DB_HOST', '127.0.0.1'),
+    'port': os.getenv('DB_PORT', '5432'),
+    'dbname': os.getenv('DB_NAME', 'dbproject')
+}
+
+# Tamanho do pool: o maximo deve acompanhar o numero de threads do servidor
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_CHECK_INTERVAL = float(os.getenv('DB_POOL_CHECK_INTERVAL', '30'))
+
+
+class PoolError(psycopg.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout, check_interval, **dsn):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('Invalid pool size: min must be >= 0 and <= max, max must be >= 1')
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._dsn = dsn
+
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, instante em que foi devolvida)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        # Os cursores medem o tempo de cada instrucao (ver REQUEST METRICS)
+        conn = psycopg.connect(**self._dsn, cursor_factory=TimedCursor)
+        conn.server_cursor_factory = TimedServerCursor
+        return conn
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != pq.TransactionStatus.IDLE:
+            return False
+        # So fazemos ping se a conexao esteve parada tempo suficiente para o servidor a ter fechado
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except (Exception, psycopg.DatabaseError):
+            return False
+
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        with self._cond:
+            if self._closed:
+                raise PoolError('Connection pool is closed')
+
+            self._waiting += 1
+            try:
+                while not self._idle and self._in_use >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolError(f'Timed out after {self.timeout}s waiting for a database connection')
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+
+            waited = time.monotonic() - start
+            self._checkouts += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+        try:
+            if entry is not None:
+                conn, idle_since = entry
+                if self._is_healthy(conn, idle_since):
+                    return conn
+                with self._cond:
+                    self._discard(conn)
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        # Uma transacao deixada aberta nao pode passar para o proximo pedido
+        if not conn.closed and conn.info.transaction_status != pq.TransactionStatus.IDLE:
+            try:
+                conn.rollback()
+            except (Exception, psycopg.DatabaseError):
+                pass
+
+        with self._cond:
+            self._in_use -= 1
+            reusable = (not self._closed and not conn.closed and
+                        conn.info.transaction_status == pq.TransactionStatus.IDLE)
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'total_wait_ms': round(self._total_wait * 1000, 3),
+                'avg_wait_ms': round(self._total_wait * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3)
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_INTERVAL, **DB_CONFIG)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+_inherited_pools = []
+
+
+def _reset_pool_after_fork():
+    # Cada processo filho (p.ex. worker do gunicorn) cria o seu pool no primeiro pedido. As conexoes
+    # herdadas continuam referenciadas para nao serem fechadas aqui, o que terminaria as sessoes do pai
+    global _pool, _pool_lock
+    if _pool is not None:
+        _inherited_pools.append(_pool)
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+@contextmanager
 def db_connection():
-    db = psycopg2.connect(
-        user='aulaspl',
-        password='aulaspl',
-        host='127.0.0.1',
-        port='5432',
-        database='dbproject'
-    )
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+# Uma conexao (e uma transacao) por pedido, partilhada pelos helpers e pelo endpoint
+def get_db():
+    if 'db_conn' not in flask.g:
+        start = time.perf_counter()
+        flask.g.db_conn = get_pool().getconn()
+        timing = flask.g.get('timing')
+        if timing is not None:
+            timing['acquire'] += time.perf_counter() - start
+    return flask.g.db_conn
+
+
+@bp.teardown_app_request
+def release_db(error):
+    conn = flask.g.pop('db_conn', None)
+    if conn is not None:
+        # O que nao foi confirmado com commit e desfeito ao devolver a conexao ao pool
+        get_pool().putconn(conn)
+
+##########################################################
+## REQUEST METRICS
+##########################################################
+
+# Server-Timing expoe tempos internos ao cliente; desligado por omissao
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def record_statement(elapsed, statements=1):
+    # Acumula no pedido atual; fora de um pedido (comandos CLI) nao ha nada a medir
+    if flask.has_request_context():
+        timing = flask.g.get('timing')
+        if timing is not None:
+            timing['db'] += elapsed
+            timing['statements'] += statements
+
+
+# Instrucoes acima de SLOW_QUERY_MS sao registadas no log; com SLOW_QUERY_EXPLAIN_RATE > 0 uma amostra
+# dos SELECT lentos e repetida com EXPLAIN (ANALYZE, BUFFERS) e o plano vai para SLOW_QUERY_PLAN_FILE
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '500'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0'))
+SLOW_QUERY_PLAN_FILE = os.getenv('SLOW_QUERY_PLAN_FILE', 'slow_query_plans.log')
+SLOW_QUERY_PLAN_MAX_BYTES = int(os.getenv('SLOW_QUERY_PLAN_MAX_BYTES', str(5 * 1024 * 1024)))
+SLOW_QUERY_PLAN_BACKUPS = int(os.getenv('SLOW_QUERY_PLAN_BACKUPS', '5'))
+
+_plan_logger = None
+_plan_logger_lock = threading.Lock()
+
+
+def get_plan_logger():
+    # O ficheiro rotativo dos planos so e criado quando e preciso; tal como o log principal, o pedido
+    # so poe o registo numa fila e e um QueueListener proprio que escreve no ficheiro
+    global _plan_logger
+    if _plan_logger is None:
+        with _plan_logger_lock:
+            if _plan_logger is None:
+                handler = logging.handlers.RotatingFileHandler(process_log_file(SLOW_QUERY_PLAN_FILE), maxBytes=SLOW_QUERY_PLAN_MAX_BYTES, backupCount=SLOW_QUERY_PLAN_BACKUPS)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                plan_queue = queue.SimpleQueue()
+                listener = logging.handlers.QueueListener(plan_queue, handler)
+                listener.start()
+                atexit.register(listener.stop)
+
+                plan_logger = logging.getLogger('logger.plans')
+                plan_logger.propagate = False
+                plan_logger.setLevel(logging.INFO)
+                plan_logger.addHandler(logging.handlers.QueueHandler(plan_queue))
+                _plan_logger = plan_logger
+    return _plan_logger
+
+
+def params_shape(params):
+    # So os tipos (e tamanhos das listas): os valores podem ter passwords ou dados pessoais
+    def shape(value):
+        if isinstance(value, (list, tuple)):
+            return f'{type(value).__name__}[{len(value)}]'
+        return type(value).__name__
+
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: shape(value) for key, value in params.items()}
+    return [shape(value) for value in params]
+
+
+def current_endpoint():
+    if flask.has_request_context():
+        rule = flask.request.url_rule.rule if flask.request.url_rule else flask.request.path
+        return f'{flask.request.method} {rule}'
+    return 'cli'
+
+
+def log_slow_query(cur, query, params, elapsed, explain, endpoint=None):
+    endpoint = endpoint or current_endpoint()
+    sql = ' '.join(str(query).split())
+    logger.warning(f'Slow query ({elapsed * 1000:.1f} ms) in {endpoint}: {sql} | params: {params_shape(params)}')
+
+    # EXPLAIN ANALYZE volta a executar a instrucao, por isso so para SELECT (sem FOR UPDATE)
+    if not explain or random.random() >= SLOW_QUERY_EXPLAIN_RATE:
+        return
+    if not sql.upper().startswith('SELECT') or 'FOR UPDATE' in sql.upper():
+        return
+    try:
+        # Savepoint: se o EXPLAIN falhar (p.ex. statement_timeout), a transacao do pedido continua utilizavel
+        with cur.connection.transaction(), psycopg.Cursor(cur.connection) as explain_cur:
+            explain_cur.execute(f'EXPLAIN (ANALYZE, BUFFERS) {query}', params)
+            plan = '\n'.join(row[0] for row in explain_cur.fetchall())
+        get_plan_logger().info(f'{endpoint} ({elapsed * 1000:.1f} ms)\n{sql}\nparams: {params_shape(params)}\n{plan}\n')
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'EXPLAIN of slow query failed: {error}')
+
+
+class TimedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(query, params, **kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            record_statement(elapsed)
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                # Depois de um erro a transacao esta abortada: regista-se, mas sem EXPLAIN
+                log_slow_query(self, query, params, elapsed, explain=not failed)
+
+    def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            record_statement(elapsed)
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                log_slow_query(self, query, None, elapsed, explain=False)
+
+
+class TimedServerCursor(psycopg.ServerCursor):
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            record_statement(elapsed)
+            if elapsed * 1000 >= SLOW_QUERY_MS:
+                log_slow_query(self, query, params, elapsed, explain=False)
+
+    def fetchmany(self, size=0):
+        # Cada bloco e um FETCH do mesmo cursor: conta como tempo na base de dados, nao como mais uma instrucao
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(size)
+        finally:
+            record_statement(time.perf_counter() - start, statements=0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)  # o ultimo e +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}  # (endpoint, method) -> series
+        self._responses = {}  # (endpoint, method, status) -> contagem
+        self._streams = {}  # (endpoint, method) -> series das exportacoes em streaming
+
+    def observe(self, endpoint, method, status, total, db, python, acquire, statement_count):
+        with self._lock:
+            series = self._endpoints.get((endpoint, method))
+            if series is None:
+                series = self._endpoints[(endpoint, method)] = {
+                    'duration': Histogram(), 'db': Histogram(), 'acquire': Histogram(), 'python': 0.0, 'statements': 0
+                }
+            series['duration'].observe(total)
+            series['db'].observe(db)
+            series['acquire'].observe(acquire)
+            series['python'] += python
+            series['statements'] += statement_count
+            self._responses[(endpoint, method, status)] = self._responses.get((endpoint, method, status), 0) + 1
+
+    def observe_stream(self, endpoint, method, total, db):
+        with self._lock:
+            series = self._streams.get((endpoint, method))
+            if series is None:
+                series = self._streams[(endpoint, method)] = {'duration': Histogram(), 'db': Histogram()}
+            series['duration'].observe(total)
+            series['db'].observe(db)
+
+    def render(self):
+        # Formato de texto do Prometheus (version 0.0.4)
+        with self._lock:
+            lines = ['# TYPE dbproj_requests_total counter']
+            for (endpoint, method, status), count in sorted(self._responses.items()):
+                lines.append(f'dbproj_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            for metric, help_text in (('duration', 'Request latency'), ('db', 'Time spent in SQL statements per request'),
+                                      ('acquire', 'Time waiting for a pooled connection per request')):
+                name = f'dbproj_request_{metric}_seconds'
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for (endpoint, method), series in sorted(self._endpoints.items()):
+                    lines.extend(series[metric].render(name, f'endpoint="{endpoint}",method="{method}"'))
+
+            lines.append('# TYPE dbproj_request_python_seconds_total counter')
+            lines.append('# TYPE dbproj_request_statements_total counter')
+            for (endpoint, method), series in sorted(self._endpoints.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                lines.append(f'dbproj_request_python_seconds_total{{{labels}}} {series["python"]}')
+                lines.append(f'dbproj_request_statements_total{{{labels}}} {series["statements"]}')
+
+            for metric, help_text in (('duration', 'Time spent streaming an export after the response started'),
+                                      ('db', 'Time spent fetching rows while streaming an export')):
+                name = f'dbproj_export_{metric}_seconds'
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for (endpoint, method), series in sorted(self._streams.items()):
+                    lines.extend(series[metric].render(name, f'endpoint="{endpoint}",method="{method}"'))
+
+        # So se o pool ja existir: um scrape nao deve abrir conexoes (nem falhar com a base de dados em baixo)
+        pool = _pool
+        if pool is not None:
+            for key, value in pool.stats().items():
+                lines.append(f'# TYPE dbproj_pool_{key} gauge')
+                lines.append(f'dbproj_pool_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+@bp.before_app_request
+def start_timing():
+    flask.g.timing = {'start': time.perf_counter(), 'db': 0.0, 'statements': 0, 'acquire': 0.0}
+
+
+@bp.after_app_request
+def record_timing(response):
+    timing = flask.g.get('timing')
+    if timing is None:
+        return response
+
+    endpoint = flask.request.url_rule.rule if flask.request.url_rule else 'unmatched'
+    finish_timing(timing, endpoint, flask.request.method, response)
+    return response
+
+
+def finish_timing(timing, endpoint, method, response):
+    # Partilhado com asgi.py, que mede as rotas Quart com o mesmo dicionario de tempos
+    total = time.perf_counter() - timing['start']
+    python = max(total - timing['db'] - timing['acquire'], 0.0)
+    request_metrics.observe(endpoint, method, response.status_code, total, timing['db'], python, timing['acquire'], timing['statements'])
+
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = (
+            f'db;dur={timing["db"] * 1000:.2f};desc="{timing["statements"]} statements", '
+            f'acquire;dur={timing["acquire"] * 1000:.2f}, app;dur={python * 1000:.2f}, total;dur={total * 1000:.2f}'
+        )
+
+
+def record_stream_timing(start, db_start):
+    # record_timing corre antes de o corpo em streaming ser gerado; o gerador chama isto quando acaba
+    timing = flask.g.get('timing')
+    if timing is None:
+        return
+    endpoint = flask.request.url_rule.rule if flask.request.url_rule else 'unmatched'
+    request_metrics.observe_stream(endpoint, flask.request.method, time.perf_counter() - start, timing['db'] - db_start)
+
+##########################################################
+## PREPARED STATEMENTS
+##########################################################
 
-    return db
+class StatementRegistry:
+    def __init__(self):
+        self._statements = {}  # nome -> SQL
+        self._lock = threading.Lock()
+        self._prepared = WeakKeyDictionary()  # conexao -> nomes ja preparados nessa conexao
+        self._prepares = {}
+        self._executions = {}
+
+    def register(self, name, sql):
+        self._statements[name] = sql
+        self._prepares[name] = 0
+        self._executions[name] = 0
+        return name
+
+    def execute(self, cur, name, params=None):
+        # prepare=True: o psycopg faz PREPARE na primeira execucao em cada conexao e depois so EXECUTE
+        cur.execute(self._statements[name], params, prepare=True)
+        self._record(cur.connection, name)
+
+    async def execute_async(self, cur, name, params=None):
+        # Igual a execute, para cursores do psycopg.AsyncConnection (ver asgi.py)
+        await cur.execute(self._statements[name], params, prepare=True)
+        self._record(cur.connection, name)
+
+    def _record(self, conn, name):
+        with self._lock:
+            prepared = self._prepared.setdefault(conn, set())
+            if name not in prepared:
+                prepared.add(name)
+                self._prepares[name] += 1
+            self._executions[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {name: {'prepares': self._prepares[name], 'executions': self._executions[name]}
+                    for name in self._statements}
+
+
+statements = StatementRegistry()
+
+ROLES_STATEMENT = statements.register('roles_for_user', '''
+    SELECT
+        EXISTS (SELECT 1 FROM admin WHERE staff_person_id = %(id)b),
+        EXISTS (SELECT 1 FROM student WHERE person_id = %(id)b),
+        EXISTS (SELECT 1 FROM professor WHERE staff_person_id = %(id)b AND cordenad = true)
+''')
+LOGIN_STATEMENT = statements.register('person_by_username', 'SELECT id, password FROM person WHERE username = %s')
+STUDENT_BY_NUMBER_STATEMENT = statements.register('student_by_number', 'SELECT person_id FROM student WHERE n_student = %s')
+DEGREE_EXISTS_STATEMENT = statements.register('degree_by_id', 'SELECT id FROM degree WHERE id = %s')
+# Resolve aluno e curso no proprio INSERT, para poder seguir no mesmo pipeline que as pesquisas
+ENROLL_DEGREE_STATEMENT = statements.register('insert_enrollment', '''
+    INSERT INTO enrollement (enroll_date, student_person_id, degree_id)
+    SELECT %b, s.person_id, d.id
+    FROM student s, degree d
+    WHERE s.n_student = %s AND d.id = %s
+''')
+# Bloqueia a edicao antes das turmas: dois pedidos do mesmo aluno para turmas diferentes da mesma edicao
+# ficam em serie, e o NOT EXISTS de ENROLL_CLASSES_QUERY ja ve a inscricao do primeiro
+LOCK_EDITION_STATEMENT = statements.register('lock_edition', 'SELECT id FROM edition WHERE id = %b FOR UPDATE')
+LOCK_CLASSES_STATEMENT = statements.register('lock_classes', '''
+    SELECT id, capacity, edition_id, enroled_count
+    FROM class_time_table
+    WHERE id = ANY(%b)
+    ORDER BY id
+    FOR UPDATE
+''')
+
+##########################################################
+## ROLE CACHE
+##########################################################
+
+ROLE_CACHE_SIZE = int(os.getenv('ROLE_CACHE_SIZE', '4096'))
+ROLE_CACHE_TTL = float(os.getenv('ROLE_CACHE_TTL', '300'))
+
+
+class RoleCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (roles, expira_em)
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def set(self, user_id, roles, generation):
+        with self._lock:
+            # Se houve uma invalidacao enquanto liamos da base de dados, o valor ja pode estar desatualizado
+            if generation != self._generation:
+                return
+            self._entries[user_id] = (roles, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl_s': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+role_cache = RoleCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL)
+
+
+def get_roles(user_id):
+    roles = role_cache.get(user_id)
+    if roles is not None:
+        return roles
+
+    generation = role_cache.generation()
+    cur = get_db().cursor()
+    statements.execute(cur, ROLES_STATEMENT, {'id': int(user_id)})
+    admin, student, coordinator = cur.fetchone()
+
+    roles = {'admin': admin, 'student': student, 'coordinator': coordinator}
+    role_cache.set(user_id, roles, generation)
+    return roles
+
+##########################################################
+## RESULT CACHE
+##########################################################
+
+# Sem RESULT_CACHE_URL a cache e local ao processo; com redis://... e partilhada entre processos
+RESULT_CACHE_URL = os.getenv('RESULT_CACHE_URL')
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '256'))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '600'))
+
+
+class LocalResultCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # chave -> (entrada, expira_em)
+        self._versions = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, namespace):
+        with self._lock:
+            return self._versions.get(namespace, 0)
+
+    def invalidate(self, namespace):
+        # As chaves incluem a versao do namespace: mudar a versao torna as entradas antigas inalcancaveis
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'local', 'size': len(self._entries), 'maxsize': self.maxsize, 'ttl_s': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class RedisResultCache:
+    def __init__(self, url, ttl):
+        import redis
+
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, namespace):
+        return int(self._client.get(f'dbproj:version:{namespace}') or 0)
+
+    def invalidate(self, namespace):
+        self._client.incr(f'dbproj:version:{namespace}')
+
+    def get(self, key):
+        raw = self._client.get(f'dbproj:result:{key}')
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self._client.set(f'dbproj:result:{key}', json.dumps(value), ex=self.ttl)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'redis', 'ttl_s': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+if RESULT_CACHE_URL:
+    result_cache = RedisResultCache(RESULT_CACHE_URL, RESULT_CACHE_TTL)
+else:
+    result_cache = LocalResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+
+def invalidate_results(*namespaces):
+    for namespace in namespaces:
+        try:
+            result_cache.invalidate(namespace)
+        except Exception as error:
+            logger.error(f'Error invalidating cached {namespace} results: {error}')
+
+
+def get_cached_result(namespace, view_args, query_args):
+    # Partilhado com asgi.py; a versao do namespace entra na chave, por isso invalidar e so mudar a versao
+    params = sorted(view_args.items()) + sorted(query_args.items(multi=True))
+    key = f'{namespace}:v{result_cache.version(namespace)}:{json.dumps(params)}'
+    return key, result_cache.get(key)
+
+
+def make_cache_entry(body):
+    # So respostas com status de sucesso ficam na cache
+    if json.loads(body).get('status') != StatusCodes['success']:
+        return None
+    return {'body': body, 'etag': hashlib.sha1(body.encode('utf-8')).hexdigest(), 'last_modified': int(time.time())}
+
+
+def store_cached_result(key, entry):
+    try:
+        result_cache.set(key, entry)
+    except Exception as error:
+        logger.error(f'Result cache unavailable: {error}')
+
+
+def cached_response(response_class, entry, request):
+    # Responde 304 quando o cliente envia If-None-Match / If-Modified-Since ainda validos;
+    # If-None-Match tem prioridade, como em werkzeug. Serve tanto o Flask como o Quart
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(entry['etag'])
+    elif request.if_modified_since is not None:
+        not_modified = entry['last_modified'] <= request.if_modified_since.timestamp()
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = response_class('', status=304)
+    else:
+        response = response_class(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.last_modified = datetime.datetime.fromtimestamp(entry['last_modified'], tz=datetime.timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def cached_result(namespace):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            # Exportacoes em streaming nao passam pela cache
+            if export_format():
+                return f(*args, **kwargs)
+
+            try:
+                key, entry = get_cached_result(namespace, kwargs, flask.request.args)
+            except Exception as error:
+                # Se a cache partilhada falhar, o endpoint continua a responder a partir da base de dados
+                logger.error(f'Result cache unavailable: {error}')
+                return f(*args, **kwargs)
+
+            if entry is None:
+                response = f(*args, **kwargs)
+                if not isinstance(response, flask.Response) or response.status_code != 200:
+                    return response
+
+                entry = make_cache_entry(response.get_data(as_text=True))
+                if entry is None:
+                    return response
+                store_cached_result(key, entry)
+
+            return cached_response(flask.Response, entry, flask.request)
+        return decorated
+    return decorator
+
+##########################################################
+## PASSWORD HASHING
+##########################################################
+
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(os.cpu_count() or 2)))
+HASH_QUEUE_LIMIT = int(os.getenv('HASH_QUEUE_LIMIT', '64'))
+HASH_TIMEOUT = float(os.getenv('HASH_TIMEOUT', '30'))
+# Os registos em lote tem um pool proprio, com um processo por CPU: com o gunicorn cada worker so tem
+# HASH_WORKERS=1 para os logins, e um lote hasheado uma linha de cada vez nao acabava dentro do timeout.
+# Os processos so sao lancados no primeiro registo em lote do worker
+BULK_HASH_WORKERS = int(os.getenv('BULK_HASH_WORKERS', str(os.cpu_count() or 2)))
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, workers, rounds, queue_limit, timeout):
+        self.workers = workers
+        self.rounds = rounds
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._metrics = {op: {'count': 0, 'rejected': 0, 'total_ms': 0.0, 'max_ms': 0.0} for op in ('hash', 'check')}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _reserve(self, op, n=1):
+        # Rejeita logo em vez de deixar a fila crescer e os pedidos ficarem pendurados
+        with self._lock:
+            if self._pending + n > self.queue_limit:
+                self._metrics[op]['rejected'] += n
+                raise HasherBusy(f'Password hashing queue is full ({self.queue_limit} pending operations)')
+            self._pending += n
+
+    def _record(self, op, elapsed, n=1):
+        with self._lock:
+            self._pending -= n
+            metrics = self._metrics[op]
+            metrics['count'] += n
+            metrics['total_ms'] += elapsed * 1000
+            metrics['max_ms'] = max(metrics['max_ms'], elapsed * 1000 / n)
+
+    def _done(self, op, start, future):
+        # O lugar na fila so e libertado quando o processo acaba (ou o trabalho e cancelado), mesmo que
+        # o pedido ja tenha desistido por timeout; senao a fila aceitava mais trabalho do que o limite.
+        # Um trabalho cancelado nunca correu: so liberta o lugar, sem entrar nos tempos
+        if future.cancelled():
+            with self._lock:
+                self._pending -= 1
+            return
+        self._record(op, time.perf_counter() - start)
+
+    def _submit(self, op, fn, args_list):
+        futures = []
+        try:
+            executor = self._get_executor()
+            for args in args_list:
+                future = executor.submit(fn, *args)
+                future.add_done_callback(partial(self._done, op, time.perf_counter()))
+                futures.append(future)
+        except BaseException:
+            with self._lock:
+                self._pending -= len(args_list) - len(futures)
+            for future in futures:
+                future.cancel()
+            raise
+        return futures
+
+    def _wait(self, op, fn, args_list):
+        self._reserve(op, len(args_list))
+        try:
+            futures = self._submit(op, fn, args_list)
+            try:
+                return [future.result(timeout=self.timeout) for future in futures]
+            except BaseException:
+                # O que ainda estiver na fila do pool nao chega a correr
+                for future in futures:
+                    future.cancel()
+                raise
+        except FuturesTimeout:
+            raise HasherBusy(f'Password hashing did not finish within {self.timeout}s')
+        except BrokenProcessPool as error:
+            with self._lock:
+                self._executor = None
+            logger.error(f'Password hashing pool broken: {error}')
+            raise HasherBusy('Password hashing is temporarily unavailable') from error
+        except Exception as error:
+            # Erros ao lancar os processos ou a serializar o trabalho seguem o mesmo caminho (503) em vez de um 500 sem JSON
+            logger.error(f'Password hashing error: {error}')
+            raise HasherBusy('Password hashing is temporarily unavailable') from error
+
+    def hash(self, password):
+        return self._wait('hash', bcrypt_hash, [(password, self.rounds)])[0]
+
+    def check(self, password, stored_hash):
+        return self._wait('check', bcrypt_check, [(password, stored_hash)])[0]
+
+    def hash_many(self, passwords):
+        # Submete em blocos do tamanho do pool para os logins nao ficarem atras de um lote inteiro
+        hashes = []
+        for i in range(0, len(passwords), self.workers):
+            chunk = passwords[i:i + self.workers]
+            hashes.extend(self._wait('hash', bcrypt_hash, [(password, self.rounds) for password in chunk]))
+        return hashes
+
+    def needs_rehash(self, stored_hash):
+        # Formato bcrypt: $2b$<custo>$<salt+hash>
+        try:
+            return int(stored_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def reset_after_fork(self):
+        # Os processos de hashing pertencem ao pai; o filho lanca os seus quando precisar
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def stats(self):
+        with self._lock:
+            result = {'workers': self.workers, 'rounds': self.rounds, 'queue_limit': self.queue_limit, 'pending': self._pending}
+            for op, metrics in self._metrics.items():
+                result[op] = {
+                    'count': metrics['count'],
+                    'rejected': metrics['rejected'],
+                    'total_ms': round(metrics['total_ms'], 3),
+                    'avg_ms': round(metrics['total_ms'] / metrics['count'], 3) if metrics['count'] else 0.0,
+                    'max_ms': round(metrics['max_ms'], 3)
+                }
+            return result
+
+
+password_hasher = PasswordHasher(HASH_WORKERS, BCRYPT_ROUNDS, HASH_QUEUE_LIMIT, HASH_TIMEOUT)
+os.register_at_fork(after_in_child=password_hasher.reset_after_fork)
+# Fila para dois lotes em simultaneo; um terceiro recebe 503 em vez de esperar
+bulk_password_hasher = PasswordHasher(BULK_HASH_WORKERS, BCRYPT_ROUNDS, 2 * BULK_HASH_WORKERS, HASH_TIMEOUT)
+os.register_at_fork(after_in_child=bulk_password_hasher.reset_after_fork)
+
+
+def hasher_busy_response(error):
+    return flask.jsonify({'status': StatusCodes['service_unavailable'], 'errors': str(error), 'results': None}), 503
 
 ##########################################################
 ## AUTHENTICATION HELPERS
 ##########################################################
 
+ACCESS_TOKEN_TTL = int(os.getenv('ACCESS_TOKEN_TTL', '900'))
+REFRESH_TOKEN_TTL = int(os.getenv('REFRESH_TOKEN_TTL', str(30 * 24 * 3600)))
+
+RoleErrors = {
+    'admin': 'Only admins can use this query',
+    'student': 'Only student can use this query',
+    'coordinator': 'Only coordinators can use this query'
+}
+
+
+def issue_tokens(user_id):
+    # As roles vao no token de acesso, que dura pouco; o refresh volta a le-las
+    roles = [role for role, granted in get_roles(user_id).items() if granted]
+    now = datetime.datetime.utcnow()
+
+    access_payload = {
+        'id': user_id,
+        'roles': roles,
+        'type': 'access',
+        'exp': now + datetime.timedelta(seconds=ACCESS_TOKEN_TTL)
+    }
+    refresh_payload = {
+        'id': user_id,
+        'type': 'refresh',
+        'exp': now + datetime.timedelta(seconds=REFRESH_TOKEN_TTL)
+    }
+    access_token = jwt.encode(access_payload, SECRET_KEY, algorithm='HS256')
+    refresh_token = jwt.encode(refresh_payload, SECRET_KEY, algorithm='HS256')
+    return access_token, refresh_token
+
+
+def read_token(token, expected_type):
+    # Devolve (claims, mensagem de erro); nao depende do Flask, e usada tambem por asgi.py
+    try:
+        if token.startswith("Bearer "):
+            token = token.split(" ")[1] 
+        claims = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        return None, 'Token has expired'
+    except jwt.InvalidTokenError:
+        return None, 'Invalid token'
+
+    if claims.get('type') != expected_type or not isinstance(claims.get('id'), int):
+        return None, 'Invalid token'
+
+    return claims, None
+
+
+def decode_token(token, expected_type):
+    claims, error_message = read_token(token, expected_type)
+    if error_message:
+        return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': error_message, 'results': None}), 401
+    return claims
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = flask.request.headers.get('Authorization')
-        logger.info(f'token: {token}')
+        logger.debug('token: %s', token)
 
         if not token:
             return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Token is missing!', 'results': None})
 
+        # O token e verificado uma unica vez por pedido; as claims ficam em flask.g
+        claims = decode_token(token, 'access')
+        if not isinstance(claims, dict):
+            return claims
+
+        flask.g.user_id = claims['id']
+        flask.g.roles = frozenset(claims.get('roles', ()))
+
         return f(*args, **kwargs)
     return decorated
 
 
+def requires_role(role):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if role not in flask.g.roles:
+                return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': RoleErrors[role], 'results': None}), 401
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
 ##########################################################
 ## REUSABLE FUNCTIONS
 ##########################################################
@@ -103,38 +1346,56 @@ def validate_date(date_str):
         return False, 'Invalid date format. Must be DD-MM-YYYY.'
 
 
-def verify_grade(grade_array):
-    conn = db_connection()
-    cur = conn.cursor()
+APPROVAL_GRADE = 10
+
+
+def verify_grade(cur, grade_array):
+    row_errors = []
+    valid_grades = []
+    seen_ids = set()
 
-    # Verifica IDs duplicados
-    student_ids = [grade[0] for grade in grade_array]
-    if len(student_ids) != len(set(student_ids)):
-        return False, 'Duplicate student IDs are not allowed.'
-    
-    # Verifica se os IDs dos estudantes existem
     for grade in grade_array:
-        statment="Select person_id from student where person_id = %s"
-        cur.execute(statment, (grade[0],))
-        student = cur.fetchone()
-        if not student:
-            return False, 'Student not found.'
-        if grade[1] < 0 or grade[1] > 20:
-            return False, 'Invalid grade. Must be between 0 and 20.'
-
-        statment="Select from student where n_student = %s"
-        cur.execute(statment, (grade,))
-        student = cur.fetchone()
-        if not student:
-            return False, 'Student not found.'
-        date=validate_date(grade[2])
-        if not date:
-            return False, 'Invalid date.'
+        if not isinstance(grade, list) or len(grade) != 3:
+            row_errors.append({'student_id': None, 'errors': 'Each grade must be [student_id, grade, date].'})
+            continue
 
-    return True, None
+        student_id, value, date = grade
+        if not str(student_id).isdigit():
+            row_errors.append({'student_id': student_id, 'errors': 'Invalid student ID.'})
+            continue
 
-def post_a_person():
-    data = flask.request.get_json()
+        # Verifica IDs duplicados
+        student_id = int(student_id)
+        if student_id in seen_ids:
+            row_errors.append({'student_id': student_id, 'errors': 'Duplicate student IDs are not allowed.'})
+            continue
+        seen_ids.add(student_id)
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or value > 20:
+            row_errors.append({'student_id': student_id, 'errors': 'Invalid grade. Must be between 0 and 20.'})
+            continue
+
+        is_valid, error_message = validate_date(date)
+        if not is_valid:
+            row_errors.append({'student_id': student_id, 'errors': error_message})
+            continue
+
+        valid_grades.append((student_id, value, datetime.datetime.strptime(date, '%d-%m-%Y').date()))
+
+    # Verifica se os IDs dos estudantes existem, todos numa so query
+    if valid_grades:
+        cur.execute('SELECT person_id FROM student WHERE person_id = ANY(%s)', ([grade[0] for grade in valid_grades],))
+        existing_ids = {person_id for person_id, in cur.fetchall()}
+        for grade in valid_grades:
+            if grade[0] not in existing_ids:
+                row_errors.append({'student_id': grade[0], 'errors': 'Student not found.'})
+
+    return valid_grades, row_errors
+
+PERSON_FIELDS = ('username', 'name', 'email', 'password', 'district', 'address', 'birth_date')
+
+
+def validate_person(data):
     username = data.get('username')
     name = data.get('name')
     email = data.get('email')
@@ -144,140 +1405,381 @@ def post_a_person():
     birth_date = data.get('birth_date')
 
     if not username or not email or not password or not district or not address or not birth_date or not name:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Username, email district, address, n_student , birth_date and password are required', 'results': None})
+        return False, 'Username, email district, address, n_student , birth_date and password are required'
+
+    if not all(isinstance(data.get(field), str) for field in PERSON_FIELDS):
+        return False, 'Username, name, email, password, district, address and birth_date must be strings.'
     
     if not username or len(username) < 3:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid username. Must be at least 3 characters long.', 'results': None})
+        return False, 'Invalid username. Must be at least 3 characters long.'
 
     if not email or '@' not in email or '.' not in email.split('@')[-1]:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid email format.', 'results': None})
+        return False, 'Invalid email format.'
 
     if not password or len(password) < 6:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Password must be at least 6 characters long.', 'results': None})
+        return False, 'Password must be at least 6 characters long.'
 
     if not district or len(district) < 5:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid district. Must be at least 3 characters long.', 'results': None})
+        return False, 'Invalid district. Must be at least 3 characters long.'
 
     if not address or len(address) < 5:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid address. Must be at least 5 characters long.', 'results': None})
+        return False, 'Invalid address. Must be at least 5 characters long.'
 
-    is_valid, error_message = validate_date(birth_date)
-    if not is_valid:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
+    return validate_date(birth_date)
 
-    conn = db_connection()
-    cur = conn.cursor()
 
-    person_statement = '''
+def validate_n_student(n_student):
+    if not n_student:
+        return False, 'Student number is required'
+
+    if not str(n_student).isdigit() or len(str(n_student)) != 10:
+        return False, 'Invalid student number. Must be a numeric value with exactly 10 digits.'
+
+    return True, None
+
+
+# Cada linha custa um hash bcrypt (~250 ms com custo 12 num core) e o gunicorn mata o worker ao fim de
+# 60 s: 100 linhas por processo de bulk_password_hasher ficam em ~25 s. Lotes maiores: varios pedidos
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', str(100 * BULK_HASH_WORKERS)))
+
+
+PAGE_DEFAULT_LIMIT = int(os.getenv('PAGE_DEFAULT_LIMIT', '50'))
+PAGE_MAX_LIMIT = int(os.getenv('PAGE_MAX_LIMIT', '500'))
+
+
+def parse_page_args(cursor_size):
+    # ?limit=N (limitado a PAGE_MAX_LIMIT) e ?cursor=a:b devolvido como next_cursor na pagina anterior
+    limit = flask.request.args.get('limit', str(PAGE_DEFAULT_LIMIT))
+    if not limit.isdigit() or int(limit) < 1:
+        return None, None, 'limit must be a positive integer'
+    limit = min(int(limit), PAGE_MAX_LIMIT)
+
+    cursor = flask.request.args.get('cursor')
+    if not cursor:
+        return limit, None, None
+
+    parts = cursor.split(':')
+    if len(parts) != cursor_size or not all(part.isdigit() for part in parts):
+        return None, None, 'Invalid cursor'
+    return limit, tuple(int(part) for part in parts), None
+
+
+def parse_fields(allowed_fields):
+    fields = flask.request.args.get('fields')
+    if not fields:
+        return allowed_fields, None
+
+    requested = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in requested if field not in allowed_fields]
+    if unknown or not requested:
+        return None, f'Unknown fields: {", ".join(unknown)}. Allowed fields: {", ".join(allowed_fields)}'
+    return requested, None
+
+
+EXPORT_FORMATS = ('application/x-ndjson', 'text/csv')
+EXPORT_ITERSIZE = int(os.getenv('EXPORT_ITERSIZE', '2000'))
+
+
+def export_format():
+    # Accept: application/x-ndjson ou text/csv pede exportacao em streaming em vez de JSON
+    best = flask.request.accept_mimetypes.best_match(('application/json',) + EXPORT_FORMATS)
+    return best if best in EXPORT_FORMATS else None
+
+
+def stream_export(name, export, query, params, fields, make_record):
+    # Cursor do lado do servidor: as linhas chegam em blocos de EXPORT_ITERSIZE, memoria constante
+    cur = get_db().cursor(name=f'export_{name}')
+    cur.itersize = EXPORT_ITERSIZE
+    cur.execute(query, params)
+
+    def generate():
+        start = time.perf_counter()
+        timing = flask.g.get('timing')
+        db_start = timing['db'] if timing is not None else 0.0
+        try:
+            if export == 'text/csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(fields)
+                yield buffer.getvalue()
+
+                while True:
+                    rows = cur.fetchmany(EXPORT_ITERSIZE)
+                    if not rows:
+                        break
+                    buffer.seek(0)
+                    buffer.truncate()
+                    for row in rows:
+                        record = make_record(row)
+                        writer.writerow([record[field] for field in fields])
+                    yield buffer.getvalue()
+            else:
+                while True:
+                    rows = cur.fetchmany(EXPORT_ITERSIZE)
+                    if not rows:
+                        break
+                    lines = []
+                    for row in rows:
+                        record = make_record(row)
+                        lines.append(dumps_json({field: record[field] for field in fields}))
+                    yield '\n'.join(lines) + '\n'
+        finally:
+            cur.close()
+            record_stream_timing(start, db_start)
+
+    # stream_with_context mantem o pedido (e a conexao em flask.g) vivo ate ao fim do stream
+    return flask.Response(flask.stream_with_context(generate()), mimetype=export)
+
+
+def read_bulk_rows():
+    # Aceita um array JSON ou NDJSON (um objeto por linha); linhas invalidas ficam a None
+    if flask.request.mimetype == 'application/x-ndjson':
+        rows = []
+        for line in flask.request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+            if len(rows) > BULK_MAX_ROWS:
+                break
+        return rows
+
+    data = flask.request.get_json(silent=True)
+    return data if isinstance(data, list) else None
+
+
+PERSON_STATEMENT = '''
     INSERT INTO Person (username, address, district, email, password, birth_date,name) 
     VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
     '''
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
-    person_values = (data['username'], data['address'], data['district'], data['email'], hashed_password, data['birth_date'], data['name'])
 
-    try:
-        cur.execute(person_statement, person_values)
-        person_id = cur.fetchone()[0]
-        conn.commit()
-        return person_id
-    except (Exception, psycopg2.DatabaseError) as error:
-        conn.rollback()
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
+# Inicio de um WITH que insere a pessoa; os registos de staff e professor acrescentam os seus INSERT
+# e recebem o id por "p", sem depender de (username, email) para encontrar a pessoa
+PERSON_CTE = '''
+    WITH p AS (
+        INSERT INTO Person (username, address, district, email, password, birth_date, name)
+        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
+    )'''
 
-def get_user_id(token):
-    
-    try:
-        if token.startswith("Bearer "):
-            token = token.split(" ")[1] 
-        decoded_token = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        user_id = decoded_token.get('id')
-    except jwt.ExpiredSignatureError:
-        return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Token has expired', 'results': None}), 401
-    except jwt.InvalidTokenError as e:
-        return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Invalid token', 'results': None}), 401
+STAFF_ADMIN_STATEMENT = PERSON_CTE + '''
+    , s AS (
+        INSERT INTO staff (n_staff, person_id)
+        SELECT %s, id FROM p RETURNING person_id
+    )
+    INSERT INTO admin (staff_person_id)
+    SELECT person_id FROM s RETURNING staff_person_id
+    '''
 
-    return user_id
+INSTRUCTOR_STATEMENT = PERSON_CTE + '''
+    , s AS (
+        INSERT INTO staff (n_staff, person_id)
+        SELECT %s, id FROM p RETURNING person_id
+    )
+    INSERT INTO professor (cordenad, asistente, staff_person_id)
+    SELECT %b, %b, person_id FROM s RETURNING staff_person_id
+    '''
 
-def is_admin(token):
-    user_id = get_user_id(token)
 
-    conn = db_connection()
-    cur = conn.cursor()
+def person_values():
+    # Valida o pedido e calcula o hash; devolve (valores do INSERT, None) ou (None, resposta de erro)
+    data = flask.request.get_json()
+    password = data.get('password')
+
+    is_valid, error_message = validate_person(data)
+    if not is_valid:
+        return None, flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
 
     try:
-        cur.execute('SELECT staff_person_id FROM admin WHERE staff_person_id = %s', (user_id,))
-        if not cur.fetchone():
-            return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Only admins can use this query', 'results': None}), 401
-    except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'Error checking admin status: {error}')
-        return flask.jsonify({'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}), 500
-    finally:
-        if conn is not None:
-            conn.close()
+        hashed_password = password_hasher.hash(password)
+    except HasherBusy as error:
+        return None, hasher_busy_response(error)
+
+    return (data['username'], data['address'], data['district'], data['email'], hashed_password, data['birth_date'], data['name']), None
 
-    return user_id
- 
 
-def is_student(token):
-    user_id = get_user_id(token)
+def post_a_person():
+    values, error_response = person_values()
+    if error_response is not None:
+        return error_response
 
-    conn = db_connection()
+    # Sem commit: a pessoa fica na mesma transacao do endpoint que a regista
+    conn = get_db()
     cur = conn.cursor()
+    cur.execute(PERSON_STATEMENT, values)
+    return cur.fetchone()[0]
 
-    try:
-        cur.execute('SELECT person_id FROM student WHERE person_id = %s', (user_id,))
-        if not cur.fetchone():
-            return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Only student can use this query', 'results': None}), 401
-    except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'Error checking student status: {error}')
-        return flask.jsonify({'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}), 500
-    finally:
-        if conn is not None:
-            conn.close()
+##########################################################
+## MAINTENANCE JOBS
+##########################################################
+
+def repair_enrollment_counters():
+    # Recalcula os contadores a partir das tabelas de origem; o lock impede inscricoes durante a reparacao
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute('LOCK TABLE enrolment_class IN SHARE MODE')
+            cur.execute('''
+                UPDATE class_time_table ct
+                SET enroled_count = counts.enrolled
+                FROM (
+                    SELECT ct2.id, COUNT(ec.class_time_table_id) AS enrolled
+                    FROM class_time_table ct2
+                    LEFT JOIN enrolment_class ec ON ec.class_time_table_id = ct2.id
+                    GROUP BY ct2.id
+                ) counts
+                WHERE counts.id = ct.id
+                AND ct.enroled_count IS DISTINCT FROM counts.enrolled
+            ''')
+            classes_fixed = cur.rowcount
 
-    return user_id
+            cur.execute('''
+                UPDATE edition e
+                SET enroled_count = counts.enrolled
+                FROM (
+                    SELECT e2.id, COUNT(DISTINCT ec.student_person_id) AS enrolled
+                    FROM edition e2
+                    LEFT JOIN class_time_table ct ON ct.edition_id = e2.id
+                    LEFT JOIN enrolment_class ec ON ec.class_time_table_id = ct.id
+                    GROUP BY e2.id
+                ) counts
+                WHERE counts.id = e.id
+                AND e.enroled_count IS DISTINCT FROM counts.enrolled
+            ''')
+            editions_fixed = cur.rowcount
+
+            conn.commit()
+        except (Exception, psycopg.DatabaseError):
+            conn.rollback()
+            raise
 
+    return classes_fixed, editions_fixed
 
-def is_coordinator(token):
-    user_id = get_user_id(token)
 
-    conn = db_connection()
-    cur = conn.cursor()
+def rebuild_student_averages():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute('LOCK TABLE grade IN SHARE MODE')
+            cur.execute('DELETE FROM student_average')
+            cur.execute('''
+                INSERT INTO student_average (student_person_id, district, grade_sum, grade_count)
+                SELECT p.id, p.district, SUM(g.grade), COUNT(*)
+                FROM student s
+                JOIN person p ON p.id = s.person_id
+                JOIN grade g ON g.student_person_id = s.person_id
+                GROUP BY p.id, p.district
+            ''')
+            rebuilt = cur.rowcount
+            conn.commit()
+        except (Exception, psycopg.DatabaseError):
+            conn.rollback()
+            raise
 
-    try:
-        cur.execute('SELECT cordenad FROM professor WHERE staff_person_id = %s', (user_id,))
-        if not cur.fetchone() or cur.fetchone()[0] == False:
-            return flask.jsonify({'status': StatusCodes['unauthorized'], 'errors': 'Only admins can use this query', 'results': None}), 401
-    except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'Error checking admin status: {error}')
-        return flask.jsonify({'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}), 500
-    finally:
-        if conn is not None:
-            conn.close()
+    invalidate_results('top3', 'top_by_district')
+    return rebuilt
 
-    return user_id
 
+def rebuild_monthly_approvals():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute('LOCK TABLE grade IN SHARE MODE')
+            cur.execute('DELETE FROM monthly_approval')
+            cur.execute('''
+                INSERT INTO monthly_approval (year_, month, edition_id, approved, evaluated)
+                SELECT
+                    CAST(date_part('year', g.date_of_grade) AS INTEGER),
+                    CAST(date_part('month', g.date_of_grade) AS INTEGER),
+                    p.edition_id,
+                    COUNT(*) FILTER (WHERE g.aproved),
+                    COUNT(*)
+                FROM grade g
+                JOIN period_ p ON p.id = g.period__id
+                GROUP BY 1, 2, 3
+            ''')
+            rebuilt = cur.rowcount
+            conn.commit()
+        except (Exception, psycopg.DatabaseError):
+            conn.rollback()
+            raise
+
+    invalidate_results('report')
+    return rebuilt
+
+
+def find_plan_regressions(plan):
+    # Percorre o plano em JSON e devolve os nos que indicam reagregacao aninhada
+    problems = []
+    scans = {}
+    pending = [plan[0]['Plan']]
+    while pending:
+        node = pending.pop()
+        if node.get('Parent Relationship') in ('SubPlan', 'InitPlan'):
+            problems.append(f"{node['Node Type']} runs as a {node['Parent Relationship']} ({node.get('Subplan Name', 'unnamed')})")
+        if 'Relation Name' in node:
+            scans[node['Relation Name']] = scans.get(node['Relation Name'], 0) + 1
+        pending.extend(node.get('Plans', []))
+
+    for relation, count in scans.items():
+        if count > 1:
+            problems.append(f'{relation} is scanned {count} times')
+    return problems
+
+
+def check_query_plans():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('EXPLAIN (FORMAT JSON) ' + TOP_BY_DISTRICT_QUERY)
+        plan = cur.fetchone()[0]
+    return {'top_by_district': find_plan_regressions(plan)}
+
+
+@bp.cli.command('check-plans')
+def check_plans_command():
+    failed = False
+    for query, problems in check_query_plans().items():
+        for problem in problems:
+            print(f'{query}: {problem}')
+        failed = failed or bool(problems)
+    if failed:
+        raise SystemExit(1)
+    print('Query plans OK')
+
+
+@bp.cli.command('repair-counters')
+def repair_counters_command():
+    classes_fixed, editions_fixed = repair_enrollment_counters()
+    print(f'Repaired enrollment counters: {classes_fixed} classes, {editions_fixed} editions')
+
+
+@bp.cli.command('rebuild-averages')
+def rebuild_averages_command():
+    print(f'Rebuilt averages for {rebuild_student_averages()} students')
+
+
+@bp.cli.command('rebuild-report')
+def rebuild_report_command():
+    print(f'Rebuilt {rebuild_monthly_approvals()} monthly approval rows')
 
 ##########################################################
 ## ENDPOINTS
 ##########################################################
 
-@app.route('/dbproj/user', methods=['PUT'])
+@bp.route('/dbproj/user', methods=['PUT'])
 def login_user():
     data = flask.request.get_json()
     username = data.get('username')
     password = data.get('password')
-    conn = db_connection()
-    cur = conn.cursor()
     if not username or not password:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Username and password are required', 'results': None})
     
-    statement='SELECT id, password FROM person WHERE username=%s'
-    cur.execute(statement, (username,))
+    conn = get_db()
+    cur = conn.cursor()
+    statements.execute(cur, LOGIN_STATEMENT, (username,))
     user = cur.fetchone() #fetchone vai retornar o resultado da query, a pass
 
     if not user:
@@ -287,49 +1789,77 @@ def login_user():
     user_id, stored_hash = user
 
     # compara a pass ja encriptada com a devolvida na query     
-    if not bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8')):
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid username or password', 'results': None})
+    try:
+        if not password_hasher.check(password, stored_hash):
+            return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid username or password', 'results': None})
+    except HasherBusy as error:
+        return hasher_busy_response(error)
+
+    # O custo configurado mudou: aproveitamos a password em claro para atualizar o hash
+    if password_hasher.needs_rehash(stored_hash):
+        try:
+            cur.execute('UPDATE person SET password = %s WHERE id = %s', (password_hasher.hash(password), user_id))
+            conn.commit()
+        except HasherBusy:
+            pass
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'PUT /dbproj/user - rehash error: {error}')
+            conn.rollback()
 
-    # Gerar o token JWT
-    payload = {
-        'id': user_id,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=30)  # 1 mês de validade
-    }
-    resultAuthToken = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+    # Gerar os tokens JWT
+    try:
+        access_token, refresh_token = issue_tokens(user_id)
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'PUT /dbproj/user - error: {error}')
+        return flask.jsonify({'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None})
+
+    response = {'status': StatusCodes['success'], 'errors': None, 'results': access_token, 'refresh_token': refresh_token}
+    return flask.jsonify(response)
+
+@bp.route('/dbproj/user/refresh', methods=['PUT'])
+def refresh_user_token():
+    data = flask.request.get_json()
+    refresh_token = data.get('refresh_token')
+    if not refresh_token:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Refresh token is required', 'results': None})
 
-    response = {'status': StatusCodes['success'], 'errors': None, 'results': resultAuthToken}
-    conn.close()
+    claims = decode_token(refresh_token, 'refresh')
+    if not isinstance(claims, dict):
+        return claims
+
+    try:
+        access_token, _ = issue_tokens(claims['id'])
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'PUT /dbproj/user/refresh - error: {error}')
+        return flask.jsonify({'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None})
+
+    response = {'status': StatusCodes['success'], 'errors': None, 'results': access_token}
     return flask.jsonify(response)
 
-@app.route('/dbproj/register/student', methods=['POST'])
+@bp.route('/dbproj/register/student', methods=['POST'])
 @token_required
+@requires_role('admin')
 def register_student():
     logger.info('POST /dbproj/register/student')
     
-    token = flask.request.headers.get('Authorization')
-
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
-    
     data = flask.request.get_json()
     n_student = data.get('n_student')
 
-    conn = db_connection()
-    cur = conn.cursor()
+    log_payload('POST /dbproj/register/student', data)
 
-    logger.debug(f'POST /dbproj/register/student - payload: {data}')
+    is_valid, error_message = validate_n_student(n_student)
+    if not is_valid:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
 
-    if not n_student:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Student number is required', 'results': None})
-    
-    if not n_student or not str(n_student).isdigit() or len(str(n_student)) != 10:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid student number. Must be a numeric value with exactly 10 digits.', 'results': None})
+    conn = get_db()
+    cur = conn.cursor()
 
     try:
         person_id = post_a_person()
         if person_id is None:
             return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid person data', 'results': None})
+        if not isinstance(person_id, int):
+            return person_id
 
         student_statement = '''
         INSERT INTO student (n_student, ammount, mensal_debt, person_id)
@@ -339,35 +1869,138 @@ def register_student():
 
         cur.execute(student_statement, student_values)
         conn.commit()
+        role_cache.invalidate(person_id)
+        invalidate_results('top3', 'top_by_district')
         response = {'status': StatusCodes['success'], 'errors': None, 'results': 'Student registered successfully with ID: ' + str(person_id) + ' and student number: ' + str(n_student)}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'POST /register/student - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
         conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
+    return flask.jsonify(response)
+
+@bp.route('/dbproj/register/students/bulk', methods=['POST'])
+@token_required
+@requires_role('admin')
+def register_students_bulk():
+    logger.info('POST /dbproj/register/students/bulk')
+
+    rows = read_bulk_rows()
+    if rows is None:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Body must be a JSON array or an NDJSON stream of students', 'results': None})
+    if not rows:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'At least one student is required', 'results': None})
+    if len(rows) > BULK_MAX_ROWS:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': f'At most {BULK_MAX_ROWS} students can be registered per request', 'results': None})
+
+    row_errors = []
+    valid_rows = []
+    seen_people = set()
+    seen_numbers = set()
+
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            row_errors.append({'row': index, 'errors': 'Row must be a JSON object'})
+            continue
+
+        is_valid, error_message = validate_person(row)
+        if is_valid:
+            is_valid, error_message = validate_n_student(row.get('n_student'))
+        if is_valid and ((row['username'], row['email']) in seen_people or str(row['n_student']) in seen_numbers):
+            is_valid, error_message = False, 'Duplicate username/email or student number in this request'
+
+        if not is_valid:
+            row_errors.append({'row': index, 'errors': error_message})
+            continue
+
+        seen_people.add((row['username'], row['email']))
+        seen_numbers.add(str(row['n_student']))
+        valid_rows.append((index, row))
+
+    conn = get_db()
+    cur = conn.cursor()
+
+    try:
+        # Conflitos com registos ja existentes sao verificados de uma vez, antes de gastar tempo com hashes
+        if valid_rows:
+            # Literal de array sem tipo: o PostgreSQL converte-o para o tipo de n_student (a coluna nao e
+            # convertida, por isso o indice pode ser usado); os numeros ja foram validados, so tem digitos
+            cur.execute('SELECT n_student FROM student WHERE n_student = ANY(%s)',
+                        ('{' + ','.join(str(row['n_student']) for _, row in valid_rows) + '}',))
+            existing_numbers = {str(n_student) for n_student, in cur.fetchall()}
+
+            cur.execute('''
+                SELECT username, email FROM person
+                WHERE (username, email) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+            ''', ([row['username'] for _, row in valid_rows], [row['email'] for _, row in valid_rows]))
+            existing_people = set(cur.fetchall())
+
+            remaining = []
+            for index, row in valid_rows:
+                if str(row['n_student']) in existing_numbers:
+                    row_errors.append({'row': index, 'errors': 'Student number already registered'})
+                elif (row['username'], row['email']) in existing_people:
+                    row_errors.append({'row': index, 'errors': 'Username and email already registered'})
+                else:
+                    remaining.append((index, row))
+            valid_rows = remaining
+
+        registered = []
+        if valid_rows:
+            hashes = bulk_password_hasher.hash_many([row['password'] for _, row in valid_rows])
+
+            person_values = [(row['username'], row['address'], row['district'], row['email'], hashed_password, row['birth_date'], row['name'])
+                             for (_, row), hashed_password in zip(valid_rows, hashes)]
+            # executemany envia as linhas em pipeline; returning=True deixa um resultado por linha
+            cur.executemany('''
+                INSERT INTO Person (username, address, district, email, password, birth_date, name)
+                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id, username, email
+            ''', person_values, returning=True)
+            person_ids = {}
+            while True:
+                person_id, username, email = cur.fetchone()
+                person_ids[(username, email)] = person_id
+                if not cur.nextset():
+                    break
+
+            student_values = []
+            for index, row in valid_rows:
+                person_id = person_ids[(row['username'], row['email'])]
+                student_values.append((row['n_student'], 0.0, 0.0, person_id))
+                registered.append({'row': index, 'person_id': person_id, 'n_student': row['n_student']})
+
+            cur.executemany('''
+                INSERT INTO student (n_student, ammount, mensal_debt, person_id)
+                VALUES (%s, %s, %s, %s)
+            ''', student_values)
+
+        conn.commit()
+        if registered:
+            invalidate_results('top3', 'top_by_district')
+        row_errors.sort(key=lambda error: error['row'])
+        response = {'status': StatusCodes['success'], 'errors': None, 'results': {'registered': registered, 'row_errors': row_errors}}
+
+    except HasherBusy as error:
+        conn.rollback()
+        return hasher_busy_response(error)
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /register/students/bulk - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
 
     return flask.jsonify(response)
 
-@app.route('/dbproj/register/staff', methods=['POST'])
+@bp.route('/dbproj/register/staff', methods=['POST'])
 @token_required
+@requires_role('admin')
 def register_staff_admin():
     logger.info('POST /dbproj/register/staff')
 
-    token = flask.request.headers.get('Authorization')
-
-
-    
     data = flask.request.get_json()
     n_staff = data.get('n_staff')
 
-    conn = db_connection()
-    cur = conn.cursor()
-
-    logger.debug(f'POST /dbproj/register/staff - payload: {data}')
+    log_payload('POST /dbproj/register/staff', data)
 
     if not n_staff:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Staff number is required', 'results': None})
@@ -375,57 +2008,41 @@ def register_staff_admin():
     if not n_staff or not str(n_staff).isdigit() or len(str(n_staff)) != 10:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Invalid staff number. Must be a numeric value with exactly 10 digits.', 'results': None})
 
-    try:
-        person_id = post_a_person()
-
-        staff_statement = '''
-        INSERT INTO staff (n_staff, person_id)
-        VALUES (%s, %s)
-        '''
-        staff_values = (n_staff, person_id)
+    values, error_response = person_values()
+    if error_response is not None:
+        return error_response
 
-        cur.execute(staff_statement, staff_values)
+    conn = get_db()
+    cur = conn.cursor()
 
-        admin_statement = '''
-        INSERT INTO admin (staff_person_id)
-        VALUES (%s)
-        '''
-        cur.execute(admin_statement, (person_id,))
+    try:
+        # Pessoa, staff e admin num unico statement: cada INSERT recebe o id do anterior pelo RETURNING
+        cur.execute(STAFF_ADMIN_STATEMENT, values + (n_staff,))
 
+        person_id = cur.fetchone()[0]
         conn.commit()
+        role_cache.invalidate(person_id)
         response = {'status': StatusCodes['success'], 'errors': None, 'results': 'Inserted staff with ID: ' + str(person_id) + ' and staff number: ' + str(n_staff)}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'POST /register/staff - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
         conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
-@app.route('/dbproj/register/instructor', methods=['POST'])
+@bp.route('/dbproj/register/instructor', methods=['POST'])
 @token_required
+@requires_role('admin')
 def register_instructor():
     logger.info('POST /dbproj/register/instructor')
-
-    token = flask.request.headers.get('Authorization')
-
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
-    
-    conn = db_connection()
-    cur = conn.cursor()
     
     data = flask.request.get_json()
     n_staff = data.get('n_staff')
     cordenator = data.get('cordenator')
     assistent = data.get('assistent')
 
-    logger.debug(f'POST /dbproj/register/instructor - payload: {data}')
+    log_payload('POST /dbproj/register/instructor', data)
 
     if not n_staff or not cordenator is not None or not assistent is not None:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Staff number, cordenator and assistent are required', 'results': None})
@@ -436,60 +2053,41 @@ def register_instructor():
     if not isinstance(cordenator, bool) or not isinstance(assistent, bool):
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'cordenator and assistent must be boolean values (true or false)', 'results': None})
     
-    try:
-        person_id = post_a_person()
-
-        instructor_statement = '''
-        INSERT INTO staff (n_staff, person_id)
-        VALUES (%s, %s)
-        '''
-        instructor_values = (n_staff, person_id)
+    values, error_response = person_values()
+    if error_response is not None:
+        return error_response
 
+    conn = get_db()
+    try:
         cur = conn.cursor()
-        cur.execute(instructor_statement, instructor_values)
 
-        professor_statement = '''
-        INSERT INTO professor (cordenad, asistente, staff_person_id)
-        VALUES (%s, %s, %s)
-        '''
-        professor_values = (cordenator, assistent, person_id)
-        cur.execute(professor_statement, professor_values)
+        # Pessoa, staff e professor num unico statement, como em register_staff_admin
+        cur.execute(INSTRUCTOR_STATEMENT, values + (n_staff, cordenator, assistent))
 
+        person_id = cur.fetchone()[0]
         conn.commit()
+        role_cache.invalidate(person_id)
         if cordenator:
             response = {'status': StatusCodes['success'], 'errors': None, 'results': 'Inserted instructor with ID: ' + str(person_id) + ' that is a cordenator'}
         else:
             response = {'status': StatusCodes['success'], 'errors': None, 'results': 'Inserted instructor with ID: ' + str(person_id) + ' that is an assistent'}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'POST /register/instructor - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
         conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
 
-@app.route('/dbproj/enroll_degree/<degree_id>', methods=['POST'])
+@bp.route('/dbproj/enroll_degree/<degree_id>', methods=['POST'])
 @token_required
+@requires_role('admin')
 def enroll_degree(degree_id):
-
-    token = flask.request.headers.get('Authorization')
-
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
-    
     data = flask.request.get_json()
     student_id = data.get('student_id')
     date = data.get('date')
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     if not student_id or not date:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Student ID and date are required', 'results': None})
     
@@ -497,149 +2095,165 @@ def enroll_degree(degree_id):
     if not is_valid:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
     
+    conn = get_db()
+    student_cur = conn.cursor()
+    degree_cur = conn.cursor()
+    cur = conn.cursor()
+
     try:
-        cur.execute('SELECT person_id FROM student WHERE n_student = %s', (student_id,))
-        student = cur.fetchone()
-        if not student:
+        # As duas pesquisas e o INSERT seguem num unico pipeline; se faltar alguma, o INSERT nao insere nada
+        with conn.pipeline():
+            statements.execute(student_cur, STUDENT_BY_NUMBER_STATEMENT, (str(student_id),))
+            statements.execute(degree_cur, DEGREE_EXISTS_STATEMENT, (degree_id,))
+            statements.execute(cur, ENROLL_DEGREE_STATEMENT, (datetime.datetime.strptime(date, '%d-%m-%Y').date(), str(student_id), degree_id))
+
+        if not student_cur.fetchone():
+            conn.rollback()
             return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Student not found', 'results': None})
-        student_person_id = student[0]
 
-        cur.execute('SELECT id FROM degree WHERE id = %s', (degree_id,))
-        if not cur.fetchone():
+        if not degree_cur.fetchone():
+            conn.rollback()
             return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Degree not found', 'results': None})
-        
-        statement= '''INSERT INTO enrollement (enroll_date, student_person_id, degree_id) VALUES (%s, %s, %s)'''
-        values = (date, student_person_id, degree_id)
-        cur.execute(statement, values)
-        
+
         conn.commit()
         response = {'status': StatusCodes['success'], 'results': f'Student {student_id} enrolled in degree {degree_id}'}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'POST /enroll_degree - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
         conn.rollback()
-
-    finally:
-        if conn is not None:
-            conn.close()
     
     return flask.jsonify(response)
 
-@app.route('/dbproj/enroll_activity/<activity_id>', methods=['POST'])
+@bp.route('/dbproj/enroll_activity/<activity_id>', methods=['POST'])
 @token_required
+@requires_role('student')
 def enroll_activity(activity_id):
-    token = flask.request.headers.get('Authorization')
+    student_id = flask.g.user_id
 
-    student_id = is_student(token)
-    if not isinstance(student_id, int):
-        return student_id   
+    conn = get_db()
+    cur = conn.cursor()
 
     try:
-
-        conn = db_connection()
-        cur = conn.cursor()
-
         cur.execute('''
         INSERT INTO student_extracurriclar_activities (student_person_id, extracurriclar_activities_id_activities)
         VALUES (%s, %s)
         ''', (student_id, activity_id))
 
         conn.commit()
+        invalidate_results('top3')
         response = {'status': StatusCodes['success'], 'errors': None, 'results': f'Student {student_id} enrolled in activity {activity_id}'}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'POST /enroll_activity - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        if 'conn' in locals() and conn is not None:
-            conn.rollback()
-    finally:
-        if 'conn' in locals() and conn is not None:
-            conn.close()
+        conn.rollback()
 
     return flask.jsonify(response)
-@app.route('/dbproj/enroll_course_edition/<course_edition_id>', methods=['POST'])
+
+def parse_class_ids(classes, course_edition_id):
+    # Devolve (ids de turma sem repetidos, mensagem de erro)
+    if not classes:
+        return None, 'At least one class ID is required'
+
+    if not isinstance(classes, list) or not all(str(class_id).isdigit() for class_id in classes) or not str(course_edition_id).isdigit():
+        return None, 'Class and course edition IDs must be integers'
+
+    return list(dict.fromkeys(int(class_id) for class_id in classes)), None
+
+
+def check_classes(class_ids, class_info, course_edition_id):
+    # class_info: {id: (capacity, edition_id, enroled_count)} das turmas bloqueadas com LOCK_CLASSES_STATEMENT
+    for class_id in class_ids:
+        # Verificar se a turma pertence à edição do curso
+        if class_id not in class_info:
+            return f'Class ID {class_id} does not exist'
+
+        capacity, edition_id, enrolled_count = class_info[class_id]
+
+        if edition_id != int(course_edition_id):
+            return f'Class ID {class_id} does not belong to course edition {course_edition_id}'
+
+        # Verificar se há capacidade disponível
+        if enrolled_count >= int(capacity):
+            return f'Class ID {class_id} is full'
+
+    return None
+
+
+# Inserir em enrolment_class e atualizar os contadores das turmas e da edicao;
+# o NOT EXISTS ve o estado anterior ao INSERT, logo so conta o aluno na primeira turma da edicao
+ENROLL_CLASSES_QUERY = '''
+            WITH new_enrolments AS (
+                INSERT INTO enrolment_class (entry, student_person_id, class_time_table_id)
+                SELECT TRUE, %(student_id)s, unnest(%(class_ids)s::int[])
+                RETURNING class_time_table_id
+            ),
+            class_counts AS (
+                UPDATE class_time_table
+                SET enroled_count = enroled_count + 1
+                WHERE id IN (SELECT class_time_table_id FROM new_enrolments)
+            )
+            UPDATE edition
+            SET enroled_count = enroled_count + 1
+            WHERE id = %(edition_id)s
+            AND NOT EXISTS (
+                SELECT 1
+                FROM enrolment_class ec
+                JOIN class_time_table ct ON ct.id = ec.class_time_table_id
+                WHERE ec.student_person_id = %(student_id)s
+                AND ct.edition_id = %(edition_id)s
+            )
+'''
+
+@bp.route('/dbproj/enroll_course_edition/<course_edition_id>', methods=['POST'])
 @token_required
+@requires_role('student')
 def enroll_course_edition(course_edition_id):
     logger.info(f'POST /dbproj/enroll_course_edition/{course_edition_id}')
     
-    token = flask.request.headers.get('Authorization')
-
-    student_id = is_student(token)
-    if not isinstance(student_id, int):
-        return student_id   
+    student_id = flask.g.user_id
 
     data = flask.request.get_json()
     classes = data.get('classes', [])
 
-    if not classes:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'At least one class ID is required', 'results': None})
+    class_ids, error_message = parse_class_ids(classes, course_edition_id)
+    if error_message:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
 
-        logger.debug(f'Student ID: {student_id}, Classes: {classes}')
-
-        for class_id in classes:
-            # Verificar se a turma pertence à edição do curso
-            cur.execute('''
-                SELECT capacity, edition_id
-                FROM class_time_table
-                WHERE id = %s
-            ''', (class_id,))
-            class_info = cur.fetchone()
-
-            if not class_info:
-                return flask.jsonify({'status': StatusCodes['api_error'], 'errors': f'Class ID {class_id} does not exist', 'results': None})
-
-            capacity, edition_id = class_info
+        logger.debug('Student ID: %s, Classes: %s', student_id, classes)
 
-            if edition_id != int(course_edition_id):
-                return flask.jsonify({'status': StatusCodes['api_error'], 'errors': f'Class ID {class_id} does not belong to course edition {course_edition_id}', 'results': None})
+        # Bloquear a edicao e depois as turmas pedidas (sempre por esta ordem, e as turmas por id, para evitar
+        # deadlocks) serializa as inscricoes concorrentes; enroled_count e mantido na mesma transacao
+        statements.execute(cur, LOCK_EDITION_STATEMENT, (int(course_edition_id),))
+        statements.execute(cur, LOCK_CLASSES_STATEMENT, (class_ids,))
+        class_info = {row[0]: row[1:] for row in cur.fetchall()}
 
-            # Verificar se há capacidade disponível
-            cur.execute('''
-                SELECT COUNT(*) 
-                FROM enrolment_class 
-                WHERE class_time_table_id = %s
-            ''', (class_id,))
-            enrolled_count = cur.fetchone()[0]
-
-            if enrolled_count >= int(capacity):
-                return flask.jsonify({'status': StatusCodes['api_error'], 'errors': f'Class ID {class_id} is full', 'results': None})
+        error_message = check_classes(class_ids, class_info, course_edition_id)
+        if error_message:
+            return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
 
-            # Inserir na tabela enrolment_class
-            cur.execute('''
-                INSERT INTO enrolment_class (entry, student_person_id, class_time_table_id)
-                VALUES (%s, %s, %s)
-            ''', (True, student_id, class_id))
+        cur.execute(ENROLL_CLASSES_QUERY, {'student_id': student_id, 'class_ids': class_ids, 'edition_id': int(course_edition_id)})
 
         conn.commit()
         response = {'status': StatusCodes['success'], 'errors': None, 'results': f'Successfully enrolled in classes: {classes}'}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'POST /enroll_course_edition - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
         conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
-@app.route('/dbproj/submit_grades/<course_edition_id>', methods=['POST'])
+@bp.route('/dbproj/submit_grades/<course_edition_id>', methods=['POST'])
 @token_required
+@requires_role('coordinator')
 def submit_grades(course_edition_id):
-    token = flask.request.headers.get('Authorization')
-
-    coordinator_id = is_coordinator(token)
-    if not isinstance(coordinator_id, int):
-        return coordinator_id
-
-
     data = flask.request.get_json()
     period = data.get('period')
     grades = data.get('grades', [])
@@ -647,43 +2261,78 @@ def submit_grades(course_edition_id):
     if not period or not grades:
         return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Evaluation period and grades are required', 'results': None})
         
-    is_valid, error_message = verify_grade(grades)
-    if not is_valid:
-        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
+    if not isinstance(grades, list):
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'Grades must be a list of [student_id, grade, date]', 'results': None})
 
-
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
-    for grade in grades:
-        student_id=grade[0]
-        value=grade[1]
-        date=grade[2]
-        cur.execute('''insert into grade (student_person_id,period__id,date_of_degree,grade,edition_id)
-        select %s,
-        (select period_.id from period where name=%s and edition_id=%s),
-        %s,
-        %s,
-        %s''',(student_id,period,course_edition_id,date,value,course_edition_id))
-        
-    
-    
-    response = {'status': StatusCodes['success'], 'errors': None}
-    return flask.jsonify(response)
 
-@app.route('/dbproj/student_details/<student_id>', methods=['GET'])
-@token_required
-def student_details(student_id):
-    token = flask.request.headers.get('Authorization')
+    try:
+        valid_grades, row_errors = verify_grade(cur, grades)
+        if row_errors:
+            return flask.jsonify({'status': StatusCodes['api_error'], 'errors': row_errors, 'results': None})
+
+        # O periodo e resolvido uma vez para todas as notas
+        cur.execute('SELECT id FROM period_ WHERE name = %s AND edition_id = %s', (period, course_edition_id))
+        period_row = cur.fetchone()
+        if not period_row:
+            return flask.jsonify({'status': StatusCodes['api_error'], 'errors': f'Evaluation period {period} not found for course edition {course_edition_id}', 'results': None})
+        period_id = period_row[0]
+
+        grade_values = [(student_id, period_id, date, value, value >= APPROVAL_GRADE) for student_id, value, date in valid_grades]
+        cur.executemany('''
+            INSERT INTO grade (student_person_id, period__id, date_of_grade, grade, aproved)
+            VALUES (%b, %b, %b, %s, %b)
+        ''', grade_values)
+
+        # Atualizar as medias pre-calculadas na mesma transacao (por ordem de aluno, para evitar deadlocks)
+        cur.execute('''
+            INSERT INTO student_average (student_person_id, district, grade_sum, grade_count)
+            SELECT p.id, p.district, new_grades.grade, 1
+            FROM unnest(%s::bigint[], %s::numeric[]) AS new_grades (student_person_id, grade)
+            JOIN person p ON p.id = new_grades.student_person_id
+            ORDER BY p.id
+            ON CONFLICT (student_person_id) DO UPDATE
+            SET grade_sum = student_average.grade_sum + EXCLUDED.grade_sum,
+                grade_count = student_average.grade_count + EXCLUDED.grade_count
+        ''', ([student_id for student_id, _, _ in valid_grades], [Decimal(str(value)) for _, value, _ in valid_grades]))
+
+        # Acumular aprovacoes por (ano, mes) desta edicao para o relatorio mensal
+        monthly = {}
+        for _, value, date in valid_grades:
+            approved, evaluated = monthly.get((date.year, date.month), (0, 0))
+            monthly[(date.year, date.month)] = (approved + (value >= APPROVAL_GRADE), evaluated + 1)
+        cur.executemany('''
+            INSERT INTO monthly_approval (year_, month, edition_id, approved, evaluated)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (year_, month, edition_id) DO UPDATE
+            SET approved = monthly_approval.approved + EXCLUDED.approved,
+                evaluated = monthly_approval.evaluated + EXCLUDED.evaluated
+        ''', [(year, month, course_edition_id, approved, evaluated) for (year, month), (approved, evaluated) in sorted(monthly.items())])
 
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
+        conn.commit()
+        invalidate_results('top3', 'top_by_district', 'report')
+        response = {'status': StatusCodes['success'], 'errors': None, 'results': f'Submitted {len(grade_values)} grades for course edition {course_edition_id}'}
 
-    conn = db_connection()
-    cur = conn.cursor()
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /submit_grades - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
+        conn.rollback()
 
-    try:
-        cur.execute('''
+    return flask.jsonify(response)
+
+STUDENT_DETAILS_FIELDS = ('course_edition_id', 'course_name', 'course_edition_year', 'grade')
+
+# Edicoes em que o aluno tem turmas; usado para paginar e para exportar
+STUDENT_EDITIONS_FILTER = '''EXISTS (
+                SELECT 1
+                FROM enrolment_class ec
+                JOIN class_time_table ct ON ct.id = ec.class_time_table_id
+                WHERE ec.student_person_id = %(student_id)s
+                AND ct.edition_id = e.id
+            )'''
+
+STUDENT_DETAILS_QUERY = '''
             SELECT 
                 e.id AS edition_id,
                 c.name AS course_name,
@@ -692,61 +2341,78 @@ def student_details(student_id):
             FROM edition e
             JOIN course_edition ce ON ce.edition_id = e.id
             JOIN course c ON ce.course_id_course = c.id_course
-            JOIN grade g ON g.student_person_id = %s 
-            JOIN period_ p ON p.id = g.period__id
-            WHERE EXISTS (
-                SELECT 1 FROM enrolment_class ec
-                WHERE ec.student_person_id = %s
-                AND ec.class_time_table_id IN (
-                    SELECT ct.id FROM class_time_table ct WHERE ct.edition_id = e.id
-                )
-            )
+            LEFT JOIN (
+                period_ p
+                JOIN grade g ON g.period__id = p.id AND g.student_person_id = %(student_id)s
+            ) ON p.edition_id = e.id
+            WHERE {edition_filter}
             ORDER BY e.year_ DESC, e.id DESC
-        ''', (student_id, student_id))
-        rows = cur.fetchall()
+'''
 
-        resultStudentDetails = []
-        for row in rows:
-            resultStudentDetails.append({
-                'course_edition_id': row[0],
-                'course_name': row[1],
-                'course_edition_year': row[2],
-                'grade': row[3]
-            })
-
-        response = {'status': StatusCodes['success'], 'errors': None, 'results': resultStudentDetails}
-    except Exception as e:
-        response = {'status': StatusCodes['internal_error'], 'errors': str(e), 'results': None}
-    finally:
-        if conn is not None:
-            conn.close()
 
-    return flask.jsonify(response)
+def student_details_record(row):
+    return {
+        'course_edition_id': row[0],
+        'course_name': row[1],
+        'course_edition_year': row[2],
+        'grade': row[3]
+    }
 
-@app.route('/dbproj/degree_details/<degree_id>', methods=['GET'])
+@bp.route('/dbproj/student_details/<student_id>', methods=['GET'])
 @token_required
-def degree_details(degree_id):
-
-    token = flask.request.headers.get('Authorization')
+@requires_role('admin')
+def student_details(student_id):
+    limit, cursor, error_message = parse_page_args(2)
+    if error_message:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
 
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
+    fields, error_message = parse_fields(STUDENT_DETAILS_FIELDS)
+    if error_message:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
-        cur.execute('''
-        SELECT 
-            c.id_course, 
-            c.name, 
-            e.id, 
-            e.year_, 
-            e.enroled_count, 
-            e.capacity,
-            
-            (
+        export = export_format()
+        if export:
+            return stream_export('student_details', export, STUDENT_DETAILS_QUERY.format(edition_filter=STUDENT_EDITIONS_FILTER),
+                                 {'student_id': student_id}, fields, student_details_record)
+
+        # Pagina por edicao, com keyset em (year_, id): cada pedido le no maximo 'limit' edicoes
+        keyset = 'AND (e.year_, e.id) < (%(cursor_year)s, %(cursor_id)s)' if cursor else ''
+        cur.execute(f'''
+            SELECT e.id, e.year_
+            FROM edition e
+            WHERE {STUDENT_EDITIONS_FILTER}
+            {keyset}
+            ORDER BY e.year_ DESC, e.id DESC
+            LIMIT %(limit)s
+        ''', {'student_id': student_id, 'limit': limit,
+              'cursor_year': cursor[0] if cursor else None, 'cursor_id': cursor[1] if cursor else None})
+        page = cur.fetchall()
+        next_cursor = f'{page[-1][1]}:{page[-1][0]}' if len(page) == limit else None
+
+        cur.execute(STUDENT_DETAILS_QUERY.format(edition_filter='e.id = ANY(%(editions)s)'),
+                    {'student_id': student_id, 'editions': [edition_id for edition_id, _ in page]})
+
+        resultStudentDetails = []
+        for row in cur:
+            record = student_details_record(row)
+            resultStudentDetails.append({field: record[field] for field in fields})
+
+        response = {'status': StatusCodes['success'], 'errors': None, 'results': resultStudentDetails, 'next_cursor': next_cursor}
+    except Exception as e:
+        response = {'status': StatusCodes['internal_error'], 'errors': str(e), 'results': None}
+
+    return flask.jsonify(response)
+
+DEGREE_DETAILS_FIELDS = ('course_id', 'course_name', 'course_edition_id', 'course_edition_year', 'enrolled_count', 'capacity', 'coordinator_id', 'instructors')
+
+
+def degree_details_query(fields, course_filter):
+    # As subqueries de docentes so correm se esses campos forem pedidos
+    assistants_column = '''(
             SELECT array_agg(p.id)
             FROM person p
             JOIN staff s ON p.id = s.person_id
@@ -754,8 +2420,8 @@ def degree_details(degree_id):
             JOIN professor_edition pe ON pro.staff_person_id = pe.professor_staff_person_id
             WHERE pro.asistente = true
             AND pe.edition_id = e.id
-            ) AS assistants,
-            (
+            )''' if 'instructors' in fields else 'NULL'
+    coordinator_column = '''(
             SELECT array_agg(p.id)
             FROM person p
             JOIN staff s ON p.id = s.person_id
@@ -763,292 +2429,369 @@ def degree_details(degree_id):
             JOIN professor_edition pe ON pro.staff_person_id = pe.professor_staff_person_id
             WHERE pro.cordenad = true
             AND pe.edition_id = e.id
-            ) AS coordinator
-            
-        FROM degree d
-        JOIN degree_course dc ON d.id = dc.degree_id
-        JOIN course c ON c.id_course = dc.course_id_course
+            )''' if 'coordinator_id' in fields else 'NULL'
+
+    return f'''
+        SELECT 
+            c.id_course, 
+            c.name, 
+            e.id, 
+            e.year_, 
+            e.enroled_count, 
+            e.capacity,
+            {assistants_column} AS assistants,
+            {coordinator_column} AS coordinator
+        FROM course c
         JOIN course_edition ce ON c.id_course = ce.course_id_course
         JOIN edition e ON ce.edition_id = e.id
-        WHERE d.id = %s
+        WHERE {course_filter}
+        ORDER BY c.id_course, e.id
+    '''
+
+
+def degree_details_record(row):
+    course_id, course_name, edition_id, edition_year, enrolled_count, capacity, instructors, coordinator = row
+    return {
+        'course_id': course_id,
+        'course_name': course_name,
+        'course_edition_id': edition_id,
+        'course_edition_year': edition_year,
+        'enrolled_count': enrolled_count,
+        'capacity': capacity,
+        'coordinator_id': coordinator,
+        'instructors': instructors,
+    }
+
+@bp.route('/dbproj/degree_details/<degree_id>', methods=['GET'])
+@token_required
+@requires_role('admin')
+def degree_details(degree_id):
+    limit, cursor, error_message = parse_page_args(1)
+    if error_message:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
+
+    fields, error_message = parse_fields(DEGREE_DETAILS_FIELDS)
+    if error_message:
+        return flask.jsonify({'status': StatusCodes['api_error'], 'errors': error_message, 'results': None})
+
+    conn = get_db()
+    cur = conn.cursor()
+
+    try:
+        export = export_format()
+        if export:
+            query = degree_details_query(fields, 'c.id_course IN (SELECT dc.course_id_course FROM degree_course dc WHERE dc.degree_id = %(degree_id)s)')
+            return stream_export('degree_details', export, query, {'degree_id': degree_id}, fields, degree_details_record)
+
+        # Pagina por curso, com keyset em id_course
+        keyset = 'AND c.id_course > %(cursor_course)s' if cursor else ''
+        cur.execute(f'''
+        SELECT c.id_course
+        FROM degree_course dc
+        JOIN course c ON c.id_course = dc.course_id_course
+        WHERE dc.degree_id = %(degree_id)s
+        {keyset}
         ORDER BY c.id_course
-        ''', (degree_id,))
+        LIMIT %(limit)s
+        ''', {'degree_id': degree_id, 'limit': limit, 'cursor_course': cursor[0] if cursor else None})
+        page = [row[0] for row in cur.fetchall()]
+        next_cursor = str(page[-1]) if len(page) == limit else None
+
+        cur.execute(degree_details_query(fields, 'c.id_course = ANY(%(courses)s)'), {'courses': page})
 
-        results = cur.fetchall()
         result_degree_details = []
-        
-        for row in results:
-            course_id, course_name, edition_id, edition_year, enrolled_count, capacity, instructors, coordinator = row
-            
-            course_record = {
-                'course_id': course_id,
-                'course_name': course_name,
-                'course_edition_id': edition_id,
-                'course_edition_year': edition_year,
-                'enrolled_count': enrolled_count,
-                'capacity': capacity,
-                'coordinator_id': coordinator,
-                'instructors': instructors,
-            }
-            
-            result_degree_details.append(course_record)
+        for row in cur:
+            course_record = degree_details_record(row)
+            result_degree_details.append({field: course_record[field] for field in fields})
 
-        response = {'status': StatusCodes['success'], 'errors': None, 'results': result_degree_details}
+        response = {'status': StatusCodes['success'], 'errors': None, 'results': result_degree_details, 'next_cursor': next_cursor}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'GET /dbproj/degree_details - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
         conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
-@app.route('/dbproj/top3', methods=['GET'])
-@token_required
-def top3_students():
-    logger.info('GET /dbproj/top3')
-    
-    token = flask.request.headers.get('Authorization')
-
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
-
-    conn = db_connection()
-    cur = conn.cursor()
-
-    try:
-        cur.execute('''
+TOP3_QUERY = '''
         SELECT p.name AS student_name, 
-            AVG(g.grade) AS average,
+            sa.average,
             (
-            SELECT (g_info.grade, g_info.date_of_grade, e.name, e.id)
+                SELECT COALESCE(json_agg(json_build_object(
+                    'course_edition_id', e.id,
+                    'course_edition_name', e.name,
+                    'grade', g_info.grade,
+                    'date', g_info.date_of_grade
+                ) ORDER BY g_info.date_of_grade, e.id), '[]'::json)
                 FROM grade g_info
                 JOIN period_ p2 ON g_info.period__id = p2.id
                 JOIN edition e ON p2.edition_id = e.id
-                JOIN course_edition ce ON e.id = ce.edition_id
-                JOIN course c ON c.id_course = ce.course_id_course
-                WHERE g_info.student_person_id = s.person_id
-                LIMIT 1
-            ) AS grades_info,
+                WHERE g_info.student_person_id = sa.student_person_id
+            ) AS grades,
             (
-                SELECT (STRING_AGG(ea.name::text, ','))
+                SELECT COALESCE(array_agg(ea.name::text ORDER BY ea.name), '{}')
                 FROM student_extracurriclar_activities sea
                 JOIN extracurriclar_activities ea ON ea.id_activities = sea.extracurriclar_activities_id_activities
-                WHERE sea.student_person_id = s.person_id
-            ) AS extracurricular_activities
+                WHERE sea.student_person_id = sa.student_person_id
+            ) AS activities
+                
+        FROM student_average sa
+        JOIN person p ON p.id = sa.student_person_id
+        ORDER BY sa.average DESC LIMIT 3
+        '''
+
+
+def top3_record(row):
+    student_name, average_grade, grades, activities = row
+    return {
+        'student_name': student_name,
+        'average_grade': float(average_grade),
+        'grades': grades,
+        'activities': activities
+    }
+
+@bp.route('/dbproj/top3', methods=['GET'])
+@token_required
+@requires_role('admin')
+@cached_result('top3')
+def top3_students():
+    logger.info('GET /dbproj/top3')
+
+    conn = get_db()
+    cur = conn.cursor()
+    if JSON_PASSTHROUGH:
+        cur.adapters.register_loader('json', JsonFragmentLoader)
+
+    try:
+        # As notas e atividades chegam ja como JSON/array; com JSON_PASSTHROUGH o JSON segue para a resposta tal como veio
+        cur.execute(TOP3_QUERY)
             
-        FROM student s
-        JOIN person p ON p.id = s.person_id
-        JOIN grade g ON s.person_id = g.student_person_id
-        GROUP BY s.person_id, p.username
-        ORDER BY AVG(g.grade) DESC LIMIT 3
-        ''')
-        
         results = cur.fetchall()
         result_top3 = []
-        
-        for row in results:
-            student_name, average_grade, grades_tuple, activities_string = row
-            
-            grades = []
-            if grades_tuple is not None:
-                try:
-                    tuple_string = str(grades_tuple)
-                    tuple_string = tuple_string.strip('()')
-                    
-                    parts = tuple_string.split(',')
-
-                    grade_value = int(parts[0])
-                    grade_date = parts[1].strip()
-                    course_name = parts[2].strip('"')
-                    edition_id = int(parts[3].strip())
-                    
-                    grades.append({
-                        'course_edition_id': edition_id,
-                        'course_edition_name': course_name,
-                        'grade': grade_value,
-                        'date': grade_date
-                    })
-                except Exception as e:
-                    logger.error(f"Error parsing tuple: {tuple_string}, Error: {str(e)}")
             
-            # Process activities string
-            activities = []
-            if activities_string:
-                activities = activities_string.strip('()').split(',')
-                activities = [act.strip('"') for act in activities if act.strip()]
-
-            student_record = {
-                'student_name': student_name,
-                'average_grade': float(average_grade),
-                'grades': grades,
-                'activities': activities
-            }
-                       
-            result_top3.append(student_record)
+        for row in results:
+            result_top3.append(top3_record(row))
 
         response = {'status': StatusCodes['success'], 'errors': None, 'results': result_top3}
 
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'GET /dbproj/top3 - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
         conn.rollback()
 
-    finally:
-        if conn is not None:
-            conn.close()
-
     return flask.jsonify(response)
 
-@app.route('/dbproj/top_by_district', methods=['GET'])
+# Uma unica passagem pelo indice (district, average DESC): o RANK por distrito substitui
+# a subquery correlacionada que reagregava o distrito inteiro para cada aluno
+TOP_BY_DISTRICT_QUERY = '''
+    SELECT student_id, district, average
+    FROM (
+        SELECT 
+            sa.student_person_id AS student_id,
+            sa.district,
+            sa.average,
+            RANK() OVER (PARTITION BY sa.district ORDER BY sa.average DESC) AS district_rank
+        FROM student_average sa
+    ) ranked
+    WHERE district_rank = 1
+    ORDER BY average DESC
+'''
+
+
+def top_by_district_record(row):
+    student_id, district, average_grade = row
+    return {
+        'student_id': student_id,
+        'district': district,
+        'average_grade': float(average_grade)
+    }
+
+@bp.route('/dbproj/top_by_district', methods=['GET'])
 @token_required
+@requires_role('admin')
+@cached_result('top_by_district')
 def top_by_district():
     logger.info('GET /top_by_district')
-    
-    token = flask.request.headers.get('Authorization')
 
-    admin_id = is_admin(token)
-    if not isinstance(admin_id, int):
-        return admin_id
-
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
-    cur.execute('''
-    SELECT 
-        p.id AS student_id,
-        p.district,
-        AVG(g.grade) AS average
-    FROM person p
-    JOIN student s ON p.id = s.person_id
-    JOIN grade g ON s.person_id = g.student_person_id
-    GROUP BY p.id, p.district
-    HAVING 
-        AVG(g.grade) = (
-            SELECT MAX(avg_grade)
-            FROM (
-                SELECT p2.district, AVG(g2.grade) AS avg_grade
-                FROM person p2
-                JOIN student s2 ON p2.id = s2.person_id
-                JOIN grade g2 ON s2.person_id = g2.student_person_id
-                WHERE p2.district = p.district
-                GROUP BY s2.person_id, p2.district
-            ) AS district_averages
-        )
-    ORDER BY average DESC
-    ''')
-    
+    cur.execute(TOP_BY_DISTRICT_QUERY)
+        
     results = cur.fetchall()
+
     result_top_by_district = []
     
     for row in results:
-        student_id, district, average_grade = row
-        
-        student_record = {
-            'student_id': student_id,
-            'district': district,
-            'average_grade': float(average_grade)
-        }
-        
-        result_top_by_district.append(student_record)
+        result_top_by_district.append(top_by_district_record(row))
 
     response = {'status': StatusCodes['success'], 'errors': None, 'results': result_top_by_district}
     return flask.jsonify(response)
 
-@app.route('/dbproj/report', methods=['GET'])
+MONTHLY_REPORT_FIELDS = ('year', 'month', 'course_edition_id', 'course_edition_name', 'approved', 'evaluated')
+
+# Le so a tabela monthly_approval, mantida por submit_grades (ver rebuild-report)
+MONTHLY_REPORT_QUERY = '''
+            WITH ranked AS (
+                SELECT
+                    m.year_,
+                    m.month,
+                    m.edition_id,
+                    m.approved,
+                    m.evaluated,
+                    RANK() OVER (PARTITION BY m.year_, m.month ORDER BY m.approved DESC) AS position
+                FROM monthly_approval m
+                WHERE m.evaluated > 0
+                {year_filter}
+            )
+            SELECT
+                r.year_,
+                r.month,
+                r.edition_id,
+                e.name,
+                r.approved,
+                r.evaluated
+            FROM ranked r
+            JOIN edition e ON e.id = r.edition_id
+            WHERE r.position = 1
+            ORDER BY r.year_, r.month, r.edition_id
+'''
+
+
+def monthly_report_record(row):
+    return {
+        'year': row[0],
+        'month': row[1],
+        'course_edition_id': row[2],
+        'course_edition_name': row[3],
+        'approved': row[4],
+        'evaluated': row[5]
+    }
+
+@bp.route('/dbproj/report', methods=['GET'])
 @token_required
+@requires_role('admin')
+@cached_result('report')
 def monthly_report():
-    token = flask.request.headers.get('Authorization')
+    year = flask.request.args.get('year')
+    if year is not None:
+        if not year.isdigit():
+            return flask.jsonify({'status': StatusCodes['api_error'], 'errors': 'year must be a positive integer', 'results': None})
+        year = int(year)
 
-    if is_admin(token) != 1:
-        return is_admin(token)
+    query = MONTHLY_REPORT_QUERY.format(year_filter='AND m.year_ = %(year)s' if year is not None else '')
+    params = {'year': year}
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute("""
-            WITH grades_per_month AS (
-                SELECT
-                    (CAST(date_part('month', g.date_of_grade) AS INTEGER)) AS month,
-                    p.edition_id,
-                    e.name AS course_edition_name,
+        export = export_format()
+        if export:
+            return stream_export('report', export, query, params, MONTHLY_REPORT_FIELDS, monthly_report_record)
 
-                    SUM(CASE WHEN g.aproved = TRUE THEN 1 ELSE 0 END) AS approved,
-                    COUNT(*) AS evaluated
-                FROM grade g
-                JOIN period_ p ON p.id = g.period__id
-                JOIN edition e ON p.edition_id = e.id
-                GROUP BY month, p.edition_id, e.name
-            ),
-            best_editions AS (
-                SELECT
-                    month,
-                    MAX(approved) AS max_approved
-                FROM grades_per_month
-                GROUP BY month
-            )
-            SELECT
-                g.month,
-                g.edition_id,
-                g.course_edition_name,
-                g.approved,
-                g.evaluated
-            FROM grades_per_month g
-            JOIN best_editions b ON g.month = b.month AND g.approved = b.max_approved
-            ORDER BY g.month
-        """)
-        rows = cur.fetchall()
-        resultReport = []
-        for row in rows:
-            resultReport.append({
-                'month': row[0],
-                'course_edition_id': row[1],
-                'course_edition_name': row[2],
-                'approved': row[3],
-                'evaluated': row[4]
-            })
+        cur.execute(query, params)
+        resultReport = [monthly_report_record(row) for row in cur]
         response = {'status': StatusCodes['success'], 'errors': None, 'results': resultReport}
     except Exception as e:
         response = {'status': StatusCodes['internal_error'], 'errors': str(e), 'results': None}
-    finally:
-        if conn is not None:
-            conn.close()
     return flask.jsonify(response)
 
-@app.route('/dbproj/delete_details/<student_id>', methods=['DELETE'])
+@bp.route('/dbproj/delete_details/<student_id>', methods=['DELETE'])
 @token_required
+@requires_role('admin')
 def delete_student(student_id):
     response = {'status': StatusCodes['success'], 'errors': None}
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
     try:
-        cur.execute('DELETE FROM student WHERE n_student = %s', (student_id,))
+        # Descontar o aluno dos contadores antes de as inscricoes desaparecerem, na mesma transacao
+        cur.execute('''
+            WITH student_classes AS (
+                SELECT ec.class_time_table_id, ct.edition_id
+                FROM enrolment_class ec
+                JOIN class_time_table ct ON ct.id = ec.class_time_table_id
+                JOIN student s ON s.person_id = ec.student_person_id
+                WHERE s.n_student = %s
+            ),
+            class_counts AS (
+                UPDATE class_time_table
+                SET enroled_count = enroled_count - 1
+                WHERE id IN (SELECT class_time_table_id FROM student_classes)
+            )
+            UPDATE edition
+            SET enroled_count = enroled_count - 1
+            WHERE id IN (SELECT edition_id FROM student_classes)
+        ''', (student_id,))
+        # Retirar as notas do aluno do relatorio mensal antes de serem apagadas
+        cur.execute('''
+            UPDATE monthly_approval m
+            SET approved = m.approved - d.approved,
+                evaluated = m.evaluated - d.evaluated
+            FROM (
+                SELECT
+                    CAST(date_part('year', g.date_of_grade) AS INTEGER) AS year_,
+                    CAST(date_part('month', g.date_of_grade) AS INTEGER) AS month,
+                    p.edition_id,
+                    COUNT(*) FILTER (WHERE g.aproved) AS approved,
+                    COUNT(*) AS evaluated
+                FROM grade g
+                JOIN period_ p ON p.id = g.period__id
+                JOIN student s ON s.person_id = g.student_person_id
+                WHERE s.n_student = %s
+                GROUP BY 1, 2, 3
+            ) d
+            WHERE m.year_ = d.year_ AND m.month = d.month AND m.edition_id = d.edition_id
+        ''', (student_id,))
+        cur.execute('DELETE FROM student WHERE n_student = %s RETURNING person_id', (student_id,))
+        deleted = cur.fetchone()
         conn.commit()
+        if deleted:
+            role_cache.invalidate(deleted[0])
+            invalidate_results('top3', 'top_by_district', 'report')
         response = {'status': StatusCodes['success'], 'errors': None, 'results': 'Student deleted successfully'}
-    except (Exception, psycopg2.DatabaseError) as error:
+    except (Exception, psycopg.DatabaseError) as error:
         logger.error(f'DELETE /delete_details/{student_id} - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
+        conn.rollback()
+    return flask.jsonify(response)
+
+@bp.route('/dbproj/stats', methods=['GET'])
+def service_stats():
+    response = {'status': StatusCodes['success'], 'errors': None, 'results': {'pool': _pool.stats() if _pool is not None else None, 'role_cache': role_cache.stats(), 'password_hasher': password_hasher.stats(), 'bulk_password_hasher': bulk_password_hasher.stats(), 'result_cache': result_cache.stats(), 'statements': statements.stats()}}
     return flask.jsonify(response)
 
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    return flask.Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+##########################################################
+## APPLICATION
+##########################################################
+
+def create_app():
+    app = flask.Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'some_jwt_secret_key'
+    app.json = OrjsonProvider(app) if orjson is not None else StdlibJSONProvider(app)
+    app.register_blueprint(bp)
+    return app
+
+
+def close_resources():
+    # Chamado quando um worker termina (ver gunicorn.conf.py)
+    close_pool()
+    password_hasher.shutdown()
+    bulk_password_hasher.shutdown()
+
 
 if __name__ == '__main__':
     # set up logging
-    logging.basicConfig(filename='log_file.log')
-    logger = logging.getLogger('logger')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    configure_logging()
 
+    # Servidor de desenvolvimento, so para uso local; em producao usar wsgi.py
     host = '127.0.0.1'
     port = 8080
+    app = create_app()
     app.run(host=host, debug=True, threaded=True, port=port)
     logger.info(f'API stubs online: http://{host}:{port}')
@@ -0,0 +1,54 @@
+# Configuracao do gunicorn para a API (ver wsgi.py):
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#
+# Reload gracioso: kill -HUP <pid do master>. Os workers novos arrancam com o codigo atual e os
+# antigos acabam os pedidos em curso (ate graceful_timeout) antes de sair.
+
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '127.0.0.1:8080')
+
+# Varios processos para usar todos os CPUs; dentro de cada um, threads para esperar pela base de dados
+workers = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv('WEB_THREADS', '4'))
+worker_class = 'gthread'
+
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('WEB_KEEPALIVE', '5'))
+
+# Reciclar workers periodicamente (0 desliga); o jitter evita que reiniciem todos ao mesmo tempo
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', '50'))
+
+# Sem preload cada worker importa a aplicacao depois do fork, e o HUP carrega tambem codigo novo
+preload_app = False
+
+# Cada worker tem o seu pool (criado no primeiro pedido) e o seu pool de bcrypt: uma conexao por
+# thread chega, e os processos de hashing repartem-se pelos workers em vez de um por CPU em cada um.
+# Os registos em lote usam um pool a parte (BULK_HASH_WORKERS, um processo por CPU) lancado so quando e preciso
+os.environ.setdefault('DB_POOL_MAX', str(threads))
+os.environ.setdefault('DB_POOL_MIN', str(min(2, threads)))
+os.environ.setdefault('HASH_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+# Cada worker escreve os logs (e os planos das queries lentas) no seu ficheiro, com o pid no nome
+if workers > 1:
+    os.environ.setdefault('LOG_PER_PROCESS', '1')
+
+
+def when_ready(server):
+    # A cache local e por processo: uma invalidacao (submit_grades, delete_details, ...) so limpa o worker
+    # que tratou a escrita, e os outros servem top3/top_by_district/report antigos ate RESULT_CACHE_TTL
+    if workers > 1 and not os.getenv('RESULT_CACHE_URL'):
+        server.log.warning(f'{workers} workers without RESULT_CACHE_URL: cached results may be stale for up to '
+                           f'RESULT_CACHE_TTL seconds in workers that did not handle the write; set RESULT_CACHE_URL=redis://...')
+
+
+def post_fork(server, worker):
+    server.log.info(f'Worker spawned (pid: {worker.pid})')
+
+
+def worker_exit(server, worker):
+    # Fechar as conexoes do worker que sai, em vez de esperar que o servidor as feche por timeout
+    import wsgi
+    wsgi.api.close_resources()
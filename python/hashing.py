@@ -0,0 +1,16 @@
+##
+## Funcoes de hashing executadas nos processos do PasswordHasher (demo-api.py).
+##
+## Ficam num modulo importavel pelo nome: o pool usa 'spawn', e o processo filho tem de conseguir
+## importar a funcao que recebe. demo-api.py (com hifen) so e carregado pelo caminho em wsgi.py e asgi.py.
+##
+
+import bcrypt
+
+
+def bcrypt_hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def bcrypt_check(password, stored_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
@@ -0,0 +1,39 @@
+##
+## =============================================
+## ============== Bases de Dados ===============
+## ============== LEI  2024/2025 ===============
+## =============================================
+## =================== Demo ====================
+## =============================================
+## =============================================
+## === Department of Informatics Engineering ===
+## =========== University of Coimbra ===========
+## =============================================
+##
+## Ponto de entrada WSGI para producao (a partir da pasta python):
+##   gunicorn -c gunicorn.conf.py wsgi:application
+## ou, onde nao ha gunicorn (p.ex. Windows), com waitress:
+##   python wsgi.py
+##
+
+
+import importlib.util
+import os
+
+# demo-api.py nao e importavel pelo nome (tem hifen); carregamos o modulo pelo caminho
+_spec = importlib.util.spec_from_file_location('demo_api', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo-api.py'))
+api = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(api)
+
+# Com preload_app desligado cada worker configura o seu proprio pipeline de logging
+api.configure_logging()
+application = api.create_app()
+
+
+if __name__ == '__main__':
+    from waitress import serve
+
+    # waitress usa um unico processo com WEB_THREADS threads; o pool deve ter pelo menos tantas conexoes
+    host = os.getenv('HOST', '127.0.0.1')
+    port = int(os.getenv('PORT', '8080'))
+    serve(application, host=host, port=port, threads=int(os.getenv('WEB_THREADS', '8')))
@@ -0,0 +1,51 @@
+--
+-- Alteracoes ao esquema usadas pela API (python/demo-api.py).
+-- Correr depois de criar as tabelas do projeto:
+--   psql -U aulaspl -d dbproject -f sql/performance.sql
+--
+
+
+-- Contadores de inscricoes mantidos por enroll_course_edition e delete_details.
+-- Depois de correr este script (ou se os contadores se desviarem), recalcular com:
+--   flask --app python/demo-api.py repair-counters
+ALTER TABLE class_time_table ADD COLUMN IF NOT EXISTS enroled_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE edition ALTER COLUMN enroled_count SET DEFAULT 0;
+
+
+-- Medias por aluno mantidas incrementalmente por submit_grades; top3 e top_by_district
+-- passam a ler so desta tabela. Preencher (ou reconstruir) a partir de grade com:
+--   flask --app python/demo-api.py rebuild-averages
+CREATE TABLE IF NOT EXISTS student_average (
+    student_person_id BIGINT PRIMARY KEY REFERENCES student (person_id) ON DELETE CASCADE,
+    district          TEXT NOT NULL,
+    grade_sum         NUMERIC NOT NULL DEFAULT 0,
+    grade_count       INTEGER NOT NULL DEFAULT 0,
+    average           NUMERIC GENERATED ALWAYS AS (grade_sum / NULLIF(grade_count, 0)) STORED
+);
+
+CREATE INDEX IF NOT EXISTS student_average_district_average_idx ON student_average (district, average DESC);
+CREATE INDEX IF NOT EXISTS student_average_average_idx ON student_average (average DESC);
+
+
+-- Indice de suporte: notas por aluno (rebuild-averages, top3, student_details).
+-- 'flask --app python/demo-api.py check-plans' falha se top_by_district voltar a um plano com subqueries aninhadas.
+CREATE INDEX IF NOT EXISTS grade_student_person_id_idx ON grade (student_person_id);
+
+
+-- student_details: edicoes do aluno via enrolment_class -> class_time_table, e notas
+-- ligadas a edicao pelo period_ (sem produto cartesiano edicoes x notas).
+CREATE INDEX IF NOT EXISTS enrolment_class_student_class_idx ON enrolment_class (student_person_id, class_time_table_id);
+CREATE INDEX IF NOT EXISTS class_time_table_edition_id_idx ON class_time_table (edition_id);
+
+
+-- Aprovacoes por (ano, mes, edicao) mantidas por submit_grades e delete_details;
+-- /dbproj/report le so desta tabela. Preencher (ou reconstruir) a partir de grade com:
+--   flask --app python/demo-api.py rebuild-report
+CREATE TABLE IF NOT EXISTS monthly_approval (
+    year_      INTEGER NOT NULL,
+    month      INTEGER NOT NULL,
+    edition_id BIGINT NOT NULL REFERENCES edition (id) ON DELETE CASCADE,
+    approved   INTEGER NOT NULL DEFAULT 0,
+    evaluated  INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (year_, month, edition_id)
+);